@@ -8,34 +8,27 @@ import pyzfscmds.system.agnostic
 import pyzfscmds.utility
 import re
 import subprocess
-import functools
-from distutils.version import LooseVersion
+import time
 
 import zedenv.lib.be
 import zedenv.lib.check
 import zedenv.lib.configure
 
+import zedenv_grub.cache
+import zedenv_grub.fragments
 import zedenv_grub.grub
+import zedenv_grub.inventory
+import zedenv_grub.kernel_config
+import zedenv_grub.menu
+import zedenv_grub.mkconfig
+import zedenv_grub.mountinfo
+import zedenv_grub.process
+import zedenv_grub.resolver
+import zedenv_grub.retention
+import zedenv_grub.zfs
 
-from typing import List, Optional
-
-
-def source(file: str):
-    """
-    'sources' a file and manipulates environment variables
-    """
-
-    env_command = ['sh', '-c', f'set -a && . {file} && env']
-
-    try:
-        env_output = subprocess.check_output(
-            env_command, universal_newlines=True, stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"Failed to source{file}.\n{e}\n.")
-
-    for line in env_output.splitlines():
-        (key, _, value) = line.partition("=")
-        os.environ[key] = value
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, NamedTuple, Optional
 
 
 def normalize_string(str_input: str):
@@ -50,21 +43,186 @@ def normalize_string(str_input: str):
     return "_".join(str_list)
 
 
-def grub_command(command: str, call_args: List[str] = None, stderr=subprocess.PIPE):
+class CommandTimeout(RuntimeError):
+    pass
+
+
+class Deadline:
+    """
+    Latency budget for external commands, both per call and for all calls in a run.
+    Only time spent waiting on commands is charged to the run budget, not scanning
+    or building entries in between. A limit of None or 0 means no limit.
+    """
+
+    def __init__(self, call_timeout: Optional[float] = None,
+                 run_budget: Optional[float] = None):
+        self.call_timeout = call_timeout or None
+        self.run_budget = run_budget or None
+        self.spent = 0.0
+
+    def charge(self, seconds: float):
+        self.spent += seconds
+
+    def timeout(self) -> Optional[float]:
+        if self.run_budget is None:
+            return self.call_timeout
+
+        remaining = self.run_budget - self.spent
+        if self.call_timeout is None:
+            return remaining
+        return min(remaining, self.call_timeout)
+
+
+def grub_command(command: str, call_args: List[str] = None, stderr=subprocess.PIPE,
+                 deadline: Optional[Deadline] = None):
     cmd_call = [command]
     if call_args:
         cmd_call.extend(call_args)
 
+    timeout = deadline.timeout() if deadline else None
+    if timeout is not None and timeout <= 0:
+        raise CommandTimeout(f"No time left in budget to run {command}.")
+
+    start = time.monotonic()
     try:
-        cmd_output = subprocess.check_output(
-            cmd_call, universal_newlines=True, stderr=stderr)
+        cmd_output = zedenv_grub.process.check_output(cmd_call, timeout, stderr=stderr)
+    except subprocess.TimeoutExpired as e:
+        raise CommandTimeout(f"Timed out running {command}.\n{e}.")
     except subprocess.CalledProcessError as e:
         raise RuntimeError(f"Failed to run {command}.\n{e}.")
+    finally:
+        if deadline:
+            deadline.charge(time.monotonic() - start)
 
     return cmd_output.splitlines()
 
 
+class GrubProbe:
+    """
+    Memoizes grub-probe answers for a single generation run.
+    Every entry probes the same devices, so each distinct
+    (devices, target) pair only needs to be probed once.
+    Successful answers are also kept in 'store' between runs if one is given,
+    and ZFS devices are answered by 'resolver' where it can.
+    Probes that exceed 'deadline' fall back to the answer in 'last_good'.
+    """
+
+    def __init__(self, store: Optional[zedenv_grub.cache.ProbeCache] = None,
+                 resolver: Optional[zedenv_grub.resolver.ZFSResolver] = None,
+                 deadline: Optional[Deadline] = None,
+                 last_good: Optional[zedenv_grub.cache.LastGoodCache] = None):
+        self.answers = {}
+        self.store = store
+        self.resolver = resolver
+        self.deadline = deadline
+        self.last_good = last_good
+
+    def probe(self, target: str,
+              devices: Optional[List[str]] = None,
+              path: Optional[str] = None,
+              stderr=subprocess.PIPE) -> List[str]:
+        """
+        Probe either a list of devices ('--device') or a path, failures are cached too
+        """
+        key = (tuple(devices) if devices else path, target)
+
+        if key not in self.answers and devices and self.resolver:
+            resolved = self.resolver.resolve(target, devices)
+            if resolved is not None:
+                self.answers[key] = resolved
+
+        if key not in self.answers and self.store:
+            stored = self.store.get(key)
+            if stored is not None:
+                self.answers[key] = stored
+
+        if key not in self.answers:
+            if devices:
+                probe_args = ['--device', *devices, f"--target={target}"]
+            else:
+                probe_args = [f"--target={target}", path]
+            try:
+                self.answers[key] = grub_command("grub-probe", probe_args, stderr=stderr,
+                                                 deadline=self.deadline)
+            except CommandTimeout as e:
+                last_good = self.last_good.fallback(("grub-probe", *key)) \
+                    if self.last_good else None
+                self.answers[key] = e if last_good is None else last_good
+            except RuntimeError as e:
+                self.answers[key] = e
+            else:
+                if self.store:
+                    self.store.set(key, self.answers[key])
+                if self.last_good:
+                    self.last_good.set(("grub-probe", *key), self.answers[key])
+
+        answer = self.answers[key]
+        if isinstance(answer, RuntimeError):
+            raise answer
+
+        return answer
+
+
+class GrubRelPath:
+    """
+    In process replacement for grub-mkrelpath. Paths on ZFS are translated
+    from the mount table, grub-mkrelpath is only run for other filesystems.
+    """
+
+    def __init__(self, deadline: Optional[Deadline] = None,
+                 last_good: Optional[zedenv_grub.cache.LastGoodCache] = None):
+        self.mountinfo = zedenv_grub.mountinfo.MountInfo()
+        self.paths = {}
+        self.deadline = deadline
+        self.last_good = last_good
+
+    def relpath(self, path: str) -> str:
+        if path not in self.paths:
+            rel = self.mountinfo.zfs_relpath(path)
+            if rel is None:
+                rel = self.mkrelpath(path)
+            self.paths[path] = rel
+
+        return self.paths[path]
+
+    def mkrelpath(self, path: str) -> str:
+        key = ("grub-mkrelpath", path)
+        try:
+            rel = grub_command("grub-mkrelpath", [path], deadline=self.deadline)[0]
+        except CommandTimeout:
+            last_good = self.last_good.fallback(key) if self.last_good else None
+            if last_good is None:
+                raise
+            return last_good
+
+        if self.last_good:
+            self.last_good.set(key, rel)
+
+        return rel
+
+
+class EntryBody(NamedTuple):
+    """
+    Lines shared by the variants of an entry, around the kernel command line they differ in
+    """
+    head: List[str]
+    linux: str
+    tail: List[str]
+
+
 class GrubLinuxEntry:
+    """
+    A kernel in the menu, keeping only what its entries are rendered from
+    """
+
+    __slots__ = ("grub_cmdline_linux", "grub_cmdline_linux_default", "grub_devices",
+                 "grub_device_boot", "grub_probe", "grub_boot_on_zfs", "extra_bpool", "linux",
+                 "grub_os", "genkernel_arch", "basename", "dirname", "rel_dirname", "version",
+                 "rpool", "be_root", "boot_environment", "linux_root_dataset", "linux_root_device",
+                 "boot_device_id", "initrd_early", "initrd_real", "kernel_configs",
+                 "kernel_config", "inventory_config", "initramfs", "grub_default_entry",
+                 "grub_save_default", "grub_gfxpayload_linux", "grub_enable_cryptodisk",
+                 "default", "device_access", "body")
 
     def __init__(self, linux: str,
                  grub_os: str,
@@ -77,14 +235,20 @@ class GrubLinuxEntry:
                  grub_devices: Optional[List[str]],
                  default: str,
                  grub_boot_on_zfs: bool,
-                 grub_device_boot: str):
+                 extra_bpool: bool,
+                 grub_device_boot: str,
+                 grub_probe: GrubProbe,
+                 grub_relpath: GrubRelPath,
+                 kernel_configs: zedenv_grub.kernel_config.KernelConfigIndex):
 
         self.grub_cmdline_linux = grub_cmdline_linux
         self.grub_cmdline_linux_default = grub_cmdline_linux_default
         self.grub_devices = grub_devices
         self.grub_device_boot = grub_device_boot
+        self.grub_probe = grub_probe
 
         self.grub_boot_on_zfs = grub_boot_on_zfs
+        self.extra_bpool = extra_bpool
 
         self.linux = linux
         self.grub_os = grub_os
@@ -93,10 +257,15 @@ class GrubLinuxEntry:
         self.basename = os.path.basename(linux)
         self.dirname = os.path.dirname(linux)
 
-        self.boot_environment_kernels = boot_environment_kernels
+        # Only looked up while creating the entry, the directory's file list isn't kept
+        boot_files = boot_environment_kernels["files"]
 
         try:
-            self.rel_dirname = grub_command("grub-mkrelpath", [self.dirname])[0]
+            if "rel_directory" in boot_environment_kernels:
+                # Not mounted, built from a kernel inventory
+                self.rel_dirname = boot_environment_kernels["rel_directory"]
+            else:
+                self.rel_dirname = grub_relpath.relpath(self.dirname)
         except RuntimeError as e:
             sys.exit(e)
         self.version = self.get_linux_version()
@@ -111,12 +280,20 @@ class GrubLinuxEntry:
         self.linux_root_device = f"ZFS={self.linux_root_dataset}"
         self.boot_device_id = self.linux_root_dataset
 
-        self.initrd_early = self.get_initrd_early()
-        self.initrd_real = self.get_initrd_real()
+        self.initrd_early = self.get_initrd_early(boot_files)
+        self.initrd_real = self.get_initrd_real(boot_files)
 
-        self.kernel_config = self.get_kernel_config()
+        self.kernel_configs = kernel_configs
+        self.kernel_config = self.get_kernel_config(boot_files)
 
-        self.initramfs = self.get_from_config(r'CONFIG_INITRAMFS_SOURCE=(.*)$')
+        # Settings of a kernel config recorded in a kernel inventory
+        self.inventory_config = None
+        if "configs" in boot_environment_kernels and self.kernel_config and \
+                os.path.dirname(self.kernel_config) == self.dirname:
+            self.inventory_config = boot_environment_kernels["configs"].get(
+                os.path.basename(self.kernel_config), {})
+
+        self.initramfs = self.get_from_config("CONFIG_INITRAMFS_SOURCE")
 
         self.grub_default_entry = None
         if "GRUB_ACTUAL_DEFAULT" in os.environ:
@@ -139,15 +316,30 @@ class GrubLinuxEntry:
 
         self.default = default
 
-        self.grub_entries = []
+        # Lines giving the entry access to the boot device, prepared for it if None
+        self.device_access = None
+        self.body = None
 
     @staticmethod
     def entry_line(entry_line: str, submenu_indent: int = 0):
         return ("\t" * submenu_indent) + entry_line
 
+    def probe_devices(self, target: str, devices: List[str],
+                      stderr=subprocess.PIPE) -> Optional[List[str]]:
+        """
+        Probe the boot devices, None if grub-probe can't answer for them. Running out
+        of time fails the run, since the entries couldn't find the devices without it.
+        """
+        try:
+            return self.grub_probe.probe(target, devices=devices, stderr=stderr)
+        except CommandTimeout as e:
+            sys.exit(f"Failed to probe {target} of the boot device.\n{e}")
+        except RuntimeError:
+            return None
+
     def prepare_grub_to_access_device(self) -> Optional[List[str]]:
         """
-        Get device modules to load, replicates function from grub-mkconfig_lib
+        Get device modules to load, replicates function from grub-mkconfig_lib.
         """
         lines = []
 
@@ -172,28 +364,20 @@ class GrubLinuxEntry:
           abstraction="`"${grub_probe}" --device $@ --target=abstraction`"
         """
 
-        if self.grub_boot_on_zfs and not zedenv.lib.be.extra_bpool():
+        if self.grub_boot_on_zfs and not self.extra_bpool:
             devices = self.grub_devices
         else:
             devices = self.grub_device_boot
 
-        try:
-            abstraction = grub_command("grub-probe",
-                                       ['--device', *devices, '--target=abstraction'])
-        except RuntimeError:
-            pass
-        else:
+        abstraction = self.probe_devices("abstraction", devices)
+        if abstraction is not None:
             lines.extend([f"insmod {m}" for m in abstraction if m.strip() != ''])
 
         """
           fs="`"${grub_probe}" --device $@ --target=fs`"
         """
-        try:
-            fs = grub_command("grub-probe",
-                              ['--device', *devices, '--target=fs'])
-        except RuntimeError:
-            pass
-        else:
+        fs = self.probe_devices("fs", devices)
+        if fs is not None:
             lines.extend([f"insmod {f}" for f in fs if f.strip() != ''])
 
         """
@@ -204,13 +388,8 @@ class GrubLinuxEntry:
         fi
         """
         if self.grub_enable_cryptodisk:
-            try:
-                crypt_uuids = grub_command("grub-probe",
-                                           ['--device', *devices,
-                                            '--target=cryptodisk_uuid'])
-            except RuntimeError:
-                pass
-            else:
+            crypt_uuids = self.probe_devices("cryptodisk_uuid", devices)
+            if crypt_uuids is not None:
                 lines.extend(
                     [f"cryptomount -u {uuid}" for uuid in crypt_uuids if uuid.strip() != ''])
 
@@ -222,17 +401,10 @@ class GrubLinuxEntry:
             echo "set root='$fs_hint'"
           fi
         """
-        try:
-            fs_hint = grub_command("grub-probe",
-                                   ['--device',
-                                    *devices,
-                                    '--target=compatibility_hint'])
-        except RuntimeError:
-            pass
-        else:
-            if fs_hint and fs_hint[0].strip() != '':
-                hint = ''.join(fs_hint).strip()
-                lines.append(f"set root='{hint}'")
+        fs_hint = self.probe_devices("compatibility_hint", devices)
+        if fs_hint and fs_hint[0].strip() != '':
+            hint = ''.join(fs_hint).strip()
+            lines.append(f"set root='{hint}'")
         r"""
           if fs_uuid="`"${grub_probe}" --device $@ --target=fs_uuid 2> /dev/null`" ; then
             hints="`"${grub_probe}" --device $@ --target=hints_string 2> /dev/null`" || hints=
@@ -243,20 +415,10 @@ class GrubLinuxEntry:
             echo "fi"
           fi
         """
-        try:
-            fs_uuid = grub_command("grub-probe",
-                                   ['--device', *devices, '--target=fs_uuid'],
-                                   stderr=subprocess.DEVNULL)
-        except RuntimeError:
-            pass
-        else:
-            try:
-                hints_string = grub_command("grub-probe",
-                                            ['--device', *devices,
-                                             '--target=hints_string'],
-                                            stderr=subprocess.DEVNULL)
-            except RuntimeError:
-                hints_string = None
+        fs_uuid = self.probe_devices("fs_uuid", devices, stderr=subprocess.DEVNULL)
+        if fs_uuid is not None:
+            hints_string = self.probe_devices("hints_string", devices,
+                                              stderr=subprocess.DEVNULL)
 
             both_fs_string = fs_uuid[0]
             if hints_string:
@@ -323,62 +485,77 @@ class GrubLinuxEntry:
                 f"{grub_class} $menuentry_id_option 'gnulinux-simple-{self.boot_device_id}' {{",
                 submenu_indent=entry_indentation))
 
+        body = self.compile_body()
+        body_indent = "\t" * (entry_indentation + 1)
+
+        # Like 10_linux, choosing an entry other than a recovery entry makes it the default
+        if self.grub_save_default and entry_type != "recovery":
+            entry.append(f"{body_indent}savedefault")
+        entry.extend(f"{body_indent}{line}" for line in body.head)
+        entry.append(f"{body_indent}{body.linux}{grub_args}")
+        entry.extend(f"{body_indent}{line}" for line in body.tail)
+        entry.append(self.entry_line("}", entry_indentation))
+
+        return entry
+
+    def compile_body(self) -> EntryBody:
+        """
+        Build the part of the entry its simple, advanced and recovery variants share,
+        once, without indentation
+        """
+        if self.body:
+            return self.body
+
         # Graphics section
-        entry.append(self.entry_line("load_video", submenu_indent=entry_indentation + 1))
+        head = ["load_video"]
         if not self.grub_gfxpayload_linux:
-            fb_efi = self.get_from_config(r'(CONFIG_FB_EFI=y)')
-            vt_hw_console_binding = self.get_from_config(r'(CONFIG_VT_HW_CONSOLE_BINDING=y)')
+            fb_efi = self.get_from_config("CONFIG_FB_EFI")
+            vt_hw_console_binding = self.get_from_config("CONFIG_VT_HW_CONSOLE_BINDING")
 
-            if fb_efi and vt_hw_console_binding:
-                entry.append(
-                    self.entry_line('set gfxpayload=keep', submenu_indent=entry_indentation + 1))
+            if fb_efi == "y" and vt_hw_console_binding == "y":
+                head.append('set gfxpayload=keep')
         else:
-            entry.append(self.entry_line(f"set gfxpayload={self.grub_gfxpayload_linux}",
-                                         submenu_indent=entry_indentation + 1))
+            head.append(f"set gfxpayload={self.grub_gfxpayload_linux}")
 
-        entry.append(self.entry_line(f"insmod gzio", submenu_indent=entry_indentation + 1))
+        head.append(f"insmod gzio")
 
-        for module in self.prepare_grub_to_access_device():
-            entry.append(self.entry_line(module, submenu_indent=entry_indentation + 1))
+        device_access = self.device_access
+        if device_access is None:
+            device_access = self.prepare_grub_to_access_device()
+        head.extend(device_access)
 
-        entry.append(self.entry_line(f"echo 'Loading Linux {self.version} ...'",
-                                     submenu_indent=entry_indentation + 1))
+        head.append(f"echo 'Loading Linux {self.version} ...'")
         rel_linux = os.path.join(self.rel_dirname, self.basename)
-        entry.append(
-            self.entry_line(f"linux {rel_linux} root={self.linux_root_device} rw {grub_args}",
-                            submenu_indent=entry_indentation + 1))
 
+        tail = []
         initrd = self.get_initrd()
 
         if initrd:
-            entry.append(self.entry_line(f"echo 'Loading initial ramdisk ...'",
-                                         submenu_indent=entry_indentation + 1))
-            entry.append(self.entry_line(f"initrd {' '.join(initrd)}",
-                                         submenu_indent=entry_indentation + 1))
+            tail.append(f"echo 'Loading initial ramdisk ...'")
+            tail.append(f"initrd {' '.join(initrd)}")
 
-        entry.append(self.entry_line("}", entry_indentation))
+        self.body = EntryBody(head, f"linux {rel_linux} root={self.linux_root_device} rw ", tail)
 
-        return entry
+        return self.body
 
-    def get_from_config(self, pattern) -> Optional[str]:
+    def get_from_config(self, key: str) -> Optional[str]:
         """
-        Check kernel_config for initramfs setting
+        Get the value of a setting in kernel_config
         """
-        config_match = None
-        if self.kernel_config:
-            reg = re.compile(pattern)
+        if not self.kernel_config:
+            return None
 
-            with open(self.kernel_config) as f:
-                config = f.read().splitlines()
+        if self.inventory_config is not None:
+            return self.inventory_config.get(key)
 
-            config_match = next((reg.match(lm).group(1) for lm in config if reg.match(lm)), None)
+        return self.kernel_configs.get(self.kernel_config).get(key)
 
-        return config_match
+    def get_kernel_config(self, boot_files: frozenset) -> Optional[str]:
+        if f"config-{self.version}" in boot_files:
+            return f"{self.dirname}/config-{self.version}"
 
-    def get_kernel_config(self) -> Optional[str]:
-        configs = [f"{self.dirname}/config-{self.version}",
-                   f"/etc/kernels/kernel-config-{self.version}"]
-        return next((c for c in configs if os.path.isfile(c)), None)
+        config = f"/etc/kernels/kernel-config-{self.version}"
+        return config if os.path.isfile(config) else None
 
     def get_initrd(self) -> list:
         initrd = []
@@ -390,7 +567,7 @@ class GrubLinuxEntry:
 
         return initrd
 
-    def get_initrd_early(self) -> list:
+    def get_initrd_early(self, boot_files: frozenset) -> list:
         """
         Get microcode images
         https://www.mail-archive.com/grub-devel@gnu.org/msg26775.html
@@ -407,9 +584,9 @@ class GrubLinuxEntry:
         if "GRUB_EARLY_INITRD_LINUX_CUSTOM" in os.environ:
             early_initrd.extend(os.environ['GRUB_EARLY_INITRD_LINUX_CUSTOM'].split())
 
-        return [i for i in early_initrd if os.path.isfile(os.path.join(self.dirname, i))]
+        return [i for i in early_initrd if i in boot_files]
 
-    def get_initrd_real(self) -> Optional[str]:
+    def get_initrd_real(self, boot_files: frozenset) -> Optional[str]:
         initrd_list = [f"initrd.img-{self.version}",
                        f"initrd-{self.version}.img",
                        f"initrd-{self.version}.gz",
@@ -419,8 +596,7 @@ class GrubLinuxEntry:
                        f"initramfs-genkernel-{self.version}",
                        f"initramfs-genkernel-{self.genkernel_arch}-{self.version}"]
 
-        initrd_real = next(
-            (i for i in initrd_list if os.path.isfile(os.path.join(self.dirname, i))), None)
+        initrd_real = next((i for i in initrd_list if i in boot_files), None)
 
         return initrd_real
 
@@ -429,16 +605,14 @@ class GrubLinuxEntry:
         Get name of BE from kernel directory
         """
         if self.grub_boot_on_zfs:
-            if not zedenv.lib.be.extra_bpool():
+            if not self.extra_bpool:
                 if self.dirname == "/boot":
-                    target = re.search(
-                        r'.*/(.*)@/boot$', grub_command("grub-mkrelpath", [self.dirname])[0])
+                    target = re.search(r'.*/(.*)@/boot$', self.rel_dirname)
                     return target.group(1) if target else None
 
                 target = re.search(r'zedenv-(.*)/boot/*$', self.dirname)
             else:
-                target = re.search(r'zedenv-([a-zA-Z0-9_\-\.]+)@?/*$',
-                                   grub_command("grub-mkrelpath", [self.dirname])[0])
+                target = re.search(r'zedenv-([a-zA-Z0-9_\-\.]+)@?/*$', self.rel_dirname)
         else:
             target = re.search(r'zedenv-(.*)/*$', self.dirname)
 
@@ -459,7 +633,7 @@ class GrubLinuxEntry:
 
 class Generator:
 
-    def __init__(self):
+    def __init__(self, properties: Optional[zedenv_grub.zfs.Properties] = None):
 
         self.prefix = "/usr"
         self.exec_prefix = "/usr"
@@ -476,7 +650,7 @@ class Generator:
         self.entry_type = "advanced"
 
         # Update environment variables by sourcing grub defaults
-        source("/etc/default/grub")
+        zedenv_grub.mkconfig.source_defaults()
 
         grub_class = "--class gnu-linux --class gnu --class os"
 
@@ -521,6 +695,13 @@ class Generator:
         self.root_dataset = pyzfscmds.system.agnostic.mountpoint_dataset("/")
         self.be_root = zedenv.lib.be.root()
 
+        if properties is None:
+            try:
+                properties = zedenv_grub.zfs.Properties([self.root_dataset, self.be_root])
+            except RuntimeError:
+                properties = None
+        self.properties = properties
+
         # in GRUB terms, bootfs is everything after pool
         self.bootfs = "/" + self.root_dataset.split("/", 1)[1]
         self.rpool = self.root_dataset.split("/")[0]
@@ -537,26 +718,41 @@ class Generator:
 
         self.linux_entries = []
 
-        self.grub_boot = zedenv.lib.be.get_property(self.root_dataset, 'org.zedenv.grub:boot')
+        self.grub_boot = self.get_property('org.zedenv.grub:boot')
         if not self.grub_boot or self.grub_boot == "-":
             self.grub_boot = "/mnt/boot"
 
+        self.pools = None
+        self.boot_environments = None
+        self.probe_cache = self.get_probe_cache()
+        self.last_good = zedenv_grub.cache.LastGoodCache()
+        self.deadline = Deadline(
+            self.get_seconds_property("org.zedenv.grub:probetimeout", 30),
+            self.get_seconds_property("org.zedenv.grub:probebudget", 120))
+
+        self.grub_probe = GrubProbe(self.probe_cache, self.get_probe_resolver(),
+                                    self.deadline, self.last_good)
+        self.grub_relpath = GrubRelPath(self.deadline, self.last_good)
+
+        kernel_config_cache = None
+        if self.get_bool_property("org.zedenv.grub:kernelconfigcache", False):
+            kernel_config_cache = zedenv_grub.cache.Cache("kernelconfig")
+        self.kernel_configs = zedenv_grub.kernel_config.KernelConfigIndex(kernel_config_cache)
+
         # Get boot device
         try:
-            self.grub_boot_device = grub_command("grub-probe",
-                                                 ['--target=device', self.grub_boot])
+            self.grub_boot_device = self.grub_probe.probe("device", path=self.grub_boot)
         except RuntimeError as err1:
             sys.exit(f"Failed to probe boot device.\n{err1}")
 
-        grub_boot_on_zfs = zedenv.lib.be.get_property(
-            self.root_dataset, 'org.zedenv.grub:bootonzfs')
+        grub_boot_on_zfs = self.get_property('org.zedenv.grub:bootonzfs')
         if grub_boot_on_zfs.lower() in ("1", "yes"):
             self.grub_boot_on_zfs = True
         else:
             try:
-                fs_type = grub_command("grub-probe",
-                                       ['--device', *self.grub_boot_device,
-                                        '--target=fs'])
+                fs_type = self.grub_probe.probe("fs", devices=self.grub_boot_device)
+            except CommandTimeout as e:
+                sys.exit(f"Failed to probe boot device filesystem.\n{e}")
             except RuntimeError:
                 fs_type = None
 
@@ -565,19 +761,71 @@ class Generator:
             else:
                 self.grub_boot_on_zfs = False
 
-        simpleentries_set = zedenv.lib.be.get_property(
-            self.root_dataset, "org.zedenv.grub:simpleentries")
+        simpleentries_set = self.get_property("org.zedenv.grub:simpleentries")
 
         self.simpleentries = True
         if simpleentries_set and simpleentries_set.lower() in ("n", "no", "0"):
             self.simpleentries = False
 
+        activation = self.get_property("org.zedenv.grub:activation")
+        self.grubenv_activation = False
+        if activation == "grubenv":
+            self.grubenv_activation = True
+        elif activation and activation not in ("-", "mkconfig"):
+            print(f"Warning: Ignoring invalid org.zedenv.grub:activation '{activation}'.",
+                  file=sys.stderr)
+
+        if self.grubenv_activation and not self.simpleentries:
+            print("Warning: Ignoring org.zedenv.grub:simpleentries=no, activation=grubenv "
+                  "needs a simple entry for every boot environment.", file=sys.stderr)
+
+        layout = self.get_property("org.zedenv.grub:layout")
+        # Names of the fragments the menu reads, or None to keep every entry in grub.cfg
+        self.fragments = None
+        if layout == "fragments":
+            self.fragments = set()
+        elif layout and layout not in ("-", "inline"):
+            print(f"Warning: Ignoring invalid org.zedenv.grub:layout '{layout}'.",
+                  file=sys.stderr)
+
+        self.retention = zedenv_grub.retention.Policy(
+            int(self.get_limit_property("org.zedenv.grub:maxentries")),
+            self.get_limit_property("org.zedenv.grub:maxage"),
+            (self.active_boot_environment,))
+        self.kernels_per_be = int(self.get_limit_property("org.zedenv.grub:kernelsperbe"))
+
+        # Boot directories scanned at once
+        self.scan_threads = 4
+        scan_threads = self.get_property("org.zedenv.grub:scanthreads")
+        if scan_threads and scan_threads != "-":
+            try:
+                self.scan_threads = int(scan_threads)
+                if self.scan_threads < 1:
+                    raise ValueError
+            except ValueError:
+                print(f"Warning: Ignoring invalid org.zedenv.grub:scanthreads '{scan_threads}'.",
+                      file=sys.stderr)
+                self.scan_threads = 4
+
+        # Device access lines shared by every entry through a GRUB function, None if unused
+        self.shared_preamble = self.get_bool_property("org.zedenv.grub:sharedpreamble", False)
+        self.device_preamble = None
+
+        grub_subdir = self.get_property("org.zedenv.grub:grubsubdir")
+        if not grub_subdir or grub_subdir == "-":
+            grub_subdir = "grub"
+        self.fragment_dir = os.path.join(
+            "/boot", grub_subdir, zedenv_grub.fragments.FRAGMENT_DIR)
+
         boot_env_dir = "zfsenv" if self.grub_boot_on_zfs else "env"
         self.boot_env_kernels = os.path.join(self.grub_boot, boot_env_dir)
 
+        self.extra_bpool = zedenv.lib.be.extra_bpool()
+        self.kernel_inventory = self.get_bool_property("org.zedenv.grub:kernelinventory", False)
+
         # /usr/bin/grub-probe --target=device /
         try:
-            grub_device_temp = grub_command("grub-probe", ['--target=device', "/"])
+            grub_device_temp = self.grub_probe.probe("device", path="/")
         except RuntimeError as err0:
             sys.exit(f"Failed to probe root device.\n{err0}")
 
@@ -588,18 +836,139 @@ class Generator:
 
         self.boot_list = self.get_boot_environments_boot_list()
 
-    def file_valid(self, file_path):
+    def get_property(self, prop: str) -> str:
+        """
+        Get a property of the root dataset, from the snapshot if it has the dataset
+        """
+        if self.properties:
+            try:
+                return self.properties.get(self.root_dataset, prop)
+            except KeyError:
+                pass
+
+        return zedenv.lib.be.get_property(self.root_dataset, prop)
+
+    def get_bool_property(self, prop: str, default: bool) -> bool:
+        value = self.get_property(prop)
+        if not value or value == "-":
+            return default
+
+        return value.lower() in ("y", "yes", "1")
+
+    def get_seconds_property(self, prop: str, default: float) -> Optional[float]:
+        value = self.get_property(prop)
+        if not value or value == "-":
+            return default
+
+        try:
+            return float(value)
+        except ValueError:
+            print(f"Warning: Ignoring invalid {prop} '{value}'.", file=sys.stderr)
+            return default
+
+    def get_limit_property(self, prop: str) -> float:
+        """
+        Get a limit that is 0, the default, for no limit
+        """
+        value = self.get_property(prop)
+        if not value or value == "-":
+            return 0
+
+        try:
+            limit = float(value)
+            if limit < 0:
+                raise ValueError
+        except ValueError:
+            print(f"Warning: Ignoring invalid {prop} '{value}'.", file=sys.stderr)
+            return 0
+
+        return limit
+
+    def save_caches(self):
+        """
+        Write the probe caches, and report answers that were reused because probing timed out
+        """
+        for c in (self.probe_cache, self.last_good, self.kernel_configs):
+            if c:
+                try:
+                    c.save()
+                except RuntimeError as e:
+                    print(f"Warning: {e}", file=sys.stderr)
+
+        for command, *args in self.last_good.stale:
+            print(f"Warning: {command} timed out, using last known good answer "
+                  f"for {args}.", file=sys.stderr)
+
+    def get_probe_cache(self) -> Optional[zedenv_grub.cache.ProbeCache]:
+        """
+        Use the persistent grub-probe cache if 'org.zedenv.grub:probecache' is set
+        """
+        if not self.get_bool_property("org.zedenv.grub:probecache", False):
+            return None
+
+        try:
+            fingerprint = zedenv_grub.zfs.probe_fingerprint(
+                self.root_dataset, ["/", self.grub_boot], self.get_pools())
+        except RuntimeError as e:
+            print(f"Warning: Not using probe cache.\n{e}", file=sys.stderr)
+            return None
+
+        return zedenv_grub.cache.ProbeCache(fingerprint)
+
+    def get_probe_resolver(self) -> Optional[zedenv_grub.resolver.ZFSResolver]:
+        """
+        Answer ZFS probes from pool metadata if 'org.zedenv.grub:nativeprobe' is set
+        """
+        if not self.get_bool_property("org.zedenv.grub:nativeprobe", False):
+            return None
+
+        try:
+            return zedenv_grub.resolver.ZFSResolver(self.get_pools())
+        except RuntimeError as e:
+            print(f"Warning: Not using native probing.\n{e}", file=sys.stderr)
+            return None
+
+    def get_pools(self) -> zedenv_grub.zfs.Pools:
+        """
+        Pool metadata, queried once and shared by the probe cache and resolver
+        """
+        if not self.pools:
+            self.pools = zedenv_grub.zfs.Pools()
+
+        return self.pools
+
+    def get_boot_environments(self) -> zedenv_grub.zfs.BootEnvironments:
+        """
+        Boot environments, listed once and shared by inventories, retention and ordering
+        """
+        if not self.boot_environments:
+            self.boot_environments = zedenv_grub.zfs.BootEnvironments(
+                self.be_root, root_dataset=self.root_dataset)
+
+        return self.boot_environments
+
+    def get_retained(self) -> Optional[set]:
+        """
+        Get the names of the boot environments kept in the menu, or None to keep every one
+        """
+        if not self.retention.max_count and not self.retention.max_age:
+            return None
+
+        try:
+            return self.retention.retained(self.get_boot_environments())
+        except RuntimeError as e:
+            print(f"Warning: Keeping every boot environment in the menu.\n{e}", file=sys.stderr)
+            return None
+
+    def file_valid(self, file: str):
         """
         Run equivalent checks to grub_file_is_not_garbage() from grub-mkconfig_lib
+        on the name of a regular file.
         Check file is valid and not one of:
         *.dpkg - debian dpkg
         *.rpmsave | *.rpmnew
         README* | */README* - documentation
         """
-        if not os.path.isfile(file_path):
-            return False
-
-        file = os.path.basename(file_path)
         _, ext = os.path.splitext(file)
 
         if ext in self.invalid_extensions:
@@ -612,14 +981,24 @@ class Generator:
 
     def create_entry(self, kernel_dir: str, search_regex) -> Optional[dict]:
         be_boot_dir = kernel_dir
-        if self.grub_boot_on_zfs and not kernel_dir == "/boot" and not zedenv.lib.be.extra_bpool():
+        if self.grub_boot_on_zfs and not kernel_dir == "/boot" and not self.extra_bpool:
             be_boot_dir = os.path.join(kernel_dir, "boot")
 
         boot_dir = os.path.join(self.boot_env_kernels, be_boot_dir)
 
-        boot_files = os.listdir(boot_dir)
-        kernel_matches = [i for i in boot_files
-                          if search_regex.match(i) and self.file_valid(os.path.join(boot_dir, i))]
+        # Snapshot the regular files once, later existence checks are set lookups
+        try:
+            with os.scandir(boot_dir) as boot_dir_entries:
+                boot_file_list = [e.name for e in boot_dir_entries if e.is_file()]
+        except OSError as e:
+            # Such as the empty mount directory of a boot environment that failed to mount
+            print(f"Warning: Skipping {boot_dir}, its kernels won't be in the menu.\n{e}",
+                  file=sys.stderr)
+            return None
+
+        boot_files = frozenset(boot_file_list)
+        kernel_matches = [i for i in boot_file_list
+                          if search_regex.match(i) and self.file_valid(i)]
 
         return {
             "directory": boot_dir,
@@ -627,9 +1006,51 @@ class Generator:
             "kernels": kernel_matches
         }
 
-    def get_boot_environments_boot_list(self) -> List[Optional[dict]]:
+    def create_inventory_entry(self, be: dict, inventory: dict, search_regex) -> dict:
+        """
+        Build the same entry create_entry() would for a mounted boot environment,
+        from its kernel inventory
+        """
+        be_name = be["name"].rsplit("/", 1)[-1]
+        _, _, be_dataset_rel = be["name"].partition("/")
+        boot_files = list(inventory["files"])
+
+        return {
+            "directory": os.path.join(self.boot_env_kernels, f"zedenv-{be_name}", "boot"),
+            "rel_directory": f"/{be_dataset_rel}@/boot",
+            "files": frozenset(boot_files),
+            "kernels": [i for i in boot_files if search_regex.match(i) and self.file_valid(i)],
+            "configs": inventory["configs"]
+        }
+
+    def get_kernel_inventories(self) -> dict:
+        """
+        Get current kernel inventories of boot environments other than root,
+        keyed by the directory they would be mounted on
+        """
+        if not self.kernel_inventory or not self.grub_boot_on_zfs or self.extra_bpool:
+            return {}
+
+        try:
+            boot_environments = self.get_boot_environments()
+        except RuntimeError as e:
+            print(f"Warning: Not using kernel inventories.\n{e}", file=sys.stderr)
+            return {}
+
+        inventory_cache = zedenv_grub.inventory.InventoryCache()
+
+        inventories = {}
+        for be_name, be in boot_environments.table.items():
+            if not boot_environments.is_root(be):
+                inventory = zedenv_grub.inventory.fresh(be, inventory_cache)
+                if inventory:
+                    inventories[f"zedenv-{be_name}"] = (be, inventory)
+
+        return inventories
+
+    def get_boot_environments_boot_list(self) -> Iterator[dict]:
         """
-        Get a list of dicts containing all BE kernels
+        Yield a dict of the kernels in each boot directory, as it is scanned
         """
 
         vmlinuz = r'(vmlinuz-.*)'
@@ -644,14 +1065,51 @@ class Generator:
             boot_search = f"{boot_search}|{vmlinux}"
             boot_regex = re.compile(boot_search)
 
-        boot_entries = [self.create_entry(e, boot_regex)
-                        for e in os.listdir(self.boot_env_kernels)]
+        # Decided before looking at any boot environment's kernels
+        retained = self.get_retained()
+
+        def pruned(kernel_dir: str) -> bool:
+            return retained is not None and kernel_dir.startswith("zedenv-") and \
+                kernel_dir[len("zedenv-"):] not in retained
+
+        inventories = {e: inventory for e, inventory in self.get_kernel_inventories().items()
+                       if not pruned(e)}
+
+        def scan(kernel_dir: str) -> Optional[dict]:
+            # Boot environments that weren't mounted come from their inventory
+            if kernel_dir in inventories and \
+                    not os.listdir(os.path.join(self.boot_env_kernels, kernel_dir)):
+                return None
+
+            return self.create_entry(kernel_dir, boot_regex)
+
+        if os.path.isdir(self.boot_env_kernels):
+            kernel_dirs = [e for e in os.listdir(self.boot_env_kernels) if not pruned(e)]
+
+            # Freshly mounted datasets are slow to list, so they are scanned on a
+            # bounded number of workers and their entries taken in directory order
+            with ThreadPoolExecutor(
+                    max_workers=min(self.scan_threads, len(kernel_dirs)) or 1) as executor:
+                for e, entry in zip(kernel_dirs, executor.map(scan, kernel_dirs)):
+                    if entry:
+                        inventories.pop(e, None)
+                        yield entry
+
+        for be, inventory in inventories.values():
+            yield self.create_inventory_entry(be, inventory, boot_regex)
 
         # Do not use `/boot` if an extra ZFS boot pool is used.
-        if self.grub_boot_on_zfs and os.path.exists("/boot") and not zedenv.lib.be.extra_bpool():
-            boot_entries.append(self.create_entry("/boot", boot_regex))
+        if self.grub_boot_on_zfs and os.path.exists("/boot") and not self.extra_bpool:
+            entry = self.create_entry("/boot", boot_regex)
+            if entry:
+                yield entry
+
+    def newest_kernels(self, kernels: List[str]) -> List[str]:
+        kernels_sorted = sorted(kernels, reverse=True, key=Generator.kernel_sort_key)
+        if self.kernels_per_be:
+            return kernels_sorted[:self.kernels_per_be]
 
-        return boot_entries
+        return kernels_sorted
 
     def get_genkernel_arch(self):
 
@@ -669,23 +1127,185 @@ class Generator:
 
         return self.machine
 
-    def generate_grub_entries(self):
+    device_access_function = "zedenv_access_device"
+
+    def linux_entry(self, boot_entry: dict, kernel: str) -> GrubLinuxEntry:
+        grub_entry = GrubLinuxEntry(
+            os.path.join(boot_entry['directory'], kernel), self.grub_os, self.be_root,
+            self.rpool, self.genkernel_arch, boot_entry, self.grub_cmdline_linux,
+            self.grub_cmdline_linux_default, self.grub_devices, self.default,
+            self.grub_boot_on_zfs, self.extra_bpool, self.grub_boot_device, self.grub_probe,
+            self.grub_relpath, self.kernel_configs)
+
+        # Every entry accesses the same devices, so they can share one preamble
+        if self.shared_preamble:
+            if self.device_preamble is None:
+                self.device_preamble = grub_entry.prepare_grub_to_access_device()
+            grub_entry.device_access = [self.device_access_function] \
+                if self.device_preamble else []
+
+        return grub_entry
+
+    def generate_device_preamble(self) -> List[str]:
+        """
+        Define the GRUB function entries call to access the boot device
+        """
+        return [
+            f"function {self.device_access_function} {{",
+            *[GrubLinuxEntry.entry_line(line, 1) for line in self.device_preamble],
+            "}"
+        ]
+
+    def get_creation_order(self) -> dict:
+        """
+        Map boot environment names to the transaction group they were created in,
+        which unlike their names survives a rename
+        """
+        try:
+            boot_environments = self.get_boot_environments()
+        except RuntimeError as e:
+            print(f"Warning: Ordering boot environments by name.\n{e}", file=sys.stderr)
+            return {}
+
+        order = {}
+        for be_name, be in boot_environments.table.items():
+            try:
+                order[be_name] = int(be["createtxg"])
+            except ValueError:
+                continue
+
+        return order
+
+    def generate_kernel_entries(self, boot_entries: List[GrubLinuxEntry],
+                                indent: int) -> Iterator[List[str]]:
+        """
+        Generate the advanced and, if enabled, recovery entries of kernels
+        """
+        for boot_entry in boot_entries:
+            yield boot_entry.generate_entry(
+                self.grub_class, f"{self.grub_cmdline_linux} {self.grub_cmdline_linux_default}",
+                "advanced", entry_indentation=indent)
+
+            if self.grub_disable_recovery:
+                yield boot_entry.generate_entry(
+                    self.grub_class, f"single {self.grub_cmdline_linux}",
+                    "recovery", entry_indentation=indent)
+
+            # Rendered for the last time
+            boot_entry.body = None
+
+    def generate_fragment_submenu(self, boot_environment: str,
+                                  boot_entries: List[GrubLinuxEntry],
+                                  indent: int) -> Iterator[List[str]]:
+        """
+        Move the entries of a boot environment's kernels to a fragment,
+        and generate the submenu that reads it once it is opened
+        """
+        name = zedenv_grub.fragments.fragment_name(boot_environment)
+        fragment = "".join(
+            f"{line}\n" for entry in self.generate_kernel_entries(boot_entries, 0)
+            for line in entry)
+
+        try:
+            zedenv_grub.fragments.update_fragment(self.fragment_dir, name, fragment)
+        except RuntimeError as e:
+            print(f"Warning: Keeping the entries of {boot_environment} in grub.cfg.\n{e}",
+                  file=sys.stderr)
+            yield from self.generate_kernel_entries(boot_entries, indent)
+            return
+
+        self.fragments.add(name)
+
+        yield [
+            GrubLinuxEntry.entry_line(
+                f"submenu '{self.grub_os} BE [{boot_environment}]' $menuentry_id_option "
+                f"'gnulinux-advanced-{os.path.join(self.be_root, boot_environment)}' {{",
+                indent),
+            GrubLinuxEntry.entry_line(
+                zedenv_grub.fragments.source_line(boot_environment), indent + 1),
+            GrubLinuxEntry.entry_line("}", indent)
+        ]
+
+    def collect_grubenv_entries(self) -> dict:
+        """
+        Create the entries of every kernel, by boot environment,
+        newest boot environment and kernel first
+        """
+        be_entries = {}
+        for i in self.boot_list:
+            for j in self.newest_kernels(i['kernels']):
+                grub_entry = self.linux_entry(i, j)
+                be_entries.setdefault(grub_entry.boot_environment, []).append(grub_entry)
+
+        creation_order = self.get_creation_order()
+        boot_environments = sorted(
+            be_entries, reverse=True, key=lambda be: (creation_order.get(be, -1), be or ""))
+
+        for be in boot_environments:
+            be_entries[be].sort(
+                reverse=True, key=lambda e: Generator.kernel_sort_key(e.basename))
+
+        return {be: be_entries[be] for be in boot_environments}
+
+    def generate_grubenv_entries(self, be_entries: dict) -> Iterator[List[str]]:
+        """
+        Generate a menu that doesn't depend on which boot environment is active, so
+        activating one only has to change 'saved_entry' in grubenv. Every boot environment
+        gets a simple entry for its newest kernel, newest boot environment first, and
+        every kernel an advanced entry in one submenu.
+        """
+        yield zedenv_grub.menu.grubenv_default(self.active_boot_environment)
+        grub_args = f"{self.grub_cmdline_linux} {self.grub_cmdline_linux_default}"
+
+        for boot_entries in be_entries.values():
+            yield boot_entries[0].generate_entry(self.grub_class, grub_args, "simple")
+
         indent = 0
-        is_top_level = True
+        if be_entries and not self.grub_disable_submenu:
+            indent = 1
+            yield [(f"submenu 'Boot Environments ({self.grub_os})' $menuentry_id_option "
+                    f"'gnulinux-advanced-be' {{")]
+
+        for be, boot_entries in be_entries.items():
+            if indent and self.fragments is not None:
+                yield from self.generate_fragment_submenu(be, boot_entries, indent)
+            else:
+                yield from self.generate_kernel_entries(boot_entries, indent)
+
+        if indent:
+            yield ["}"]
+
+    def generate_grub_entries(self) -> Iterator[List[str]]:
+        """
+        Yield the menu an entry at a time, rendering each only once it is needed
+        """
+        # Every kernel's entry is created first, to order them
+        if self.grubenv_activation:
+            entries = self.generate_grubenv_entries(self.collect_grubenv_entries())
+        else:
+            self.collect_active_first_entries()
+            entries = self.generate_active_first_entries()
+
+        if self.device_preamble:
+            yield self.generate_device_preamble()
+
+        yield from entries
 
-        entries = []
+        try:
+            zedenv_grub.fragments.remove_stale(self.fragment_dir, self.fragments or set())
+        except RuntimeError as e:
+            print(f"Warning: {e}", file=sys.stderr)
 
+        self.save_caches()
+
+    def collect_active_first_entries(self):
+        """
+        Create the entries of every kernel, those of the active boot environment first
+        """
         for i in self.boot_list:
             entry_position = 0
-            kernels_sorted = sorted(i['kernels'], reverse=True,
-                                    key=functools.cmp_to_key(Generator.kernel_comparator))
-
-            for j in kernels_sorted:
-                grub_entry = GrubLinuxEntry(
-                    os.path.join(i['directory'], j), self.grub_os, self.be_root, self.rpool,
-                    self.genkernel_arch, i, self.grub_cmdline_linux,
-                    self.grub_cmdline_linux_default, self.grub_devices, self.default,
-                    self.grub_boot_on_zfs, self.grub_boot_device)
+            for j in self.newest_kernels(i['kernels']):
+                grub_entry = self.linux_entry(i, j)
 
                 ds = os.path.join(self.be_root, grub_entry.boot_environment)
                 if ds == self.active_boot_environment:
@@ -695,6 +1315,17 @@ class Generator:
                 else:
                     self.linux_entries.append(grub_entry)
 
+    def generate_active_first_entries(self) -> Iterator[List[str]]:
+        """
+        Generate entries of the active boot environment at the top level,
+        and those of the others in a submenu
+        """
+        indent = 0
+        is_top_level = True
+
+        # Entries of other boot environments moved to fragments, in menu order
+        fragment_entries = {}
+
         for boot_entry in self.linux_entries:
             # First few in linux_entries are active, others in submenu
             if is_top_level and os.path.join(
@@ -704,100 +1335,62 @@ class Generator:
                 indent = 1
 
                 # Submenu title
-                entries.append(
-                    [(f"submenu 'Boot Environments ({self.grub_os})' $menuentry_id_option "
-                      f"'gnulinux-advanced-be-{self.active_boot_environment}' {{")])
+                yield [(f"submenu 'Boot Environments ({self.grub_os})' $menuentry_id_option "
+                        f"'gnulinux-advanced-be-{self.active_boot_environment}' {{")]
+
+            if not is_top_level and self.fragments is not None:
+                fragment_entries.setdefault(boot_entry.boot_environment, []).append(boot_entry)
+                continue
 
             if is_top_level and self.simpleentries:
                 # Simple entry
-                entries.append(
-                    boot_entry.generate_entry(
-                        self.grub_class,
-                        f"{self.grub_cmdline_linux} {self.grub_cmdline_linux_default}",
-                        "simple", entry_indentation=indent))
-
-            # Advanced entry
-            entries.append(
-                boot_entry.generate_entry(
+                yield boot_entry.generate_entry(
                     self.grub_class,
                     f"{self.grub_cmdline_linux} {self.grub_cmdline_linux_default}",
-                    "advanced", entry_indentation=indent))
+                    "simple", entry_indentation=indent)
 
-            # Recovery entry
-            if self.grub_disable_recovery:
-                entries.append(
-                    boot_entry.generate_entry(
-                        self.grub_class,
-                        f"single {self.grub_cmdline_linux}",
-                        "recovery", entry_indentation=indent))
+            # Advanced and recovery entries
+            yield from self.generate_kernel_entries([boot_entry], indent)
+
+        for be, be_entries in fragment_entries.items():
+            yield from self.generate_fragment_submenu(be, be_entries, indent)
 
         if not is_top_level:
-            entries.append("}")
+            yield ["}"]
 
-        return entries
+    kernel_version_regex = re.compile(r'-([0-9]+([\.|\-][0-9]+)*)-')
+    kernel_version_component_regex = re.compile(r'([0-9]+|[^0-9\.])')
 
     @staticmethod
-    def kernel_comparator(kernel0: str, kernel1: str) -> int:
+    def kernel_sort_key(kernel: str) -> tuple:
         """
-        Rather than using key based compare, it is simpler to use a comparator in this situation.
+        Parse a kernel file name once into a sortable tuple of
+        (has version, version components, not a backup).
+        Versioned kernels sort after unversioned ones, and for equal versions
+        kernels ending in 'bak' or '.old' sort first.
+        Version components compare like LooseVersion, numbers as integers
+        and separators as strings.
         """
+        not_backup = not kernel.endswith(('bak', '.old'))
 
-        regex = re.compile(r'-([0-9]+([\.|\-][0-9]+)*)-')
-
-        version0 = regex.search(kernel0)
-        version1 = regex.search(kernel1)
-
-        def ext_cmp(k0: str, k1: str) -> int:
-            """
-            Check if the kernels and in an extension,
-            if one of them does consider it less than the other
-            """
-            exts = ('bak', '.old')
-            if k0.endswith(exts) or k1.endswith(exts):
-                if k0.endswith(exts) and k1.endswith(exts):
-                    return 0
-
-                if k0.endswith(exts):
-                    return -1
-                return 1
+        version = Generator.kernel_version_regex.search(kernel)
+        if not version:
+            return 0, (), not_backup
 
-            return 0
-
-        # Compare versions
-        if version0 or version1:
-            if version0 and version1:
-                sv0 = -1
-                sv1 = -1
-                try:
-                    sv0 = LooseVersion(version0.group(1))
-                except ValueError:
-                    pass
-                try:
-                    sv1 = LooseVersion(version1.group(1))
-                except ValueError:
-                    pass
+        components = tuple(
+            (1, int(c), "") if c.isdigit() else (0, 0, c)
+            for c in Generator.kernel_version_component_regex.findall(version.group(1)))
 
-                try:
-                    if sv0 < sv1:
-                        return -1
-                    if sv0 == sv1:
-                        return ext_cmp(kernel0, kernel1)
-                    return 1
-                except AttributeError:
-                    return ext_cmp(kernel0, kernel1)
-
-            if version0:
-                return 1
-            return -1
-
-        # No version
-        return ext_cmp(kernel0, kernel1)
+        return 1, components, not_backup
 
 
 if __name__ == "__main__":
 
     ran_activate = False
     bootloader_plugin = None
+    zedenv_properties = None
+    generator_state = None
+    entries_fingerprint = None
 
     if pyzfscmds.system.agnostic.check_valid_system():
 
@@ -805,8 +1398,16 @@ if __name__ == "__main__":
         if not zedenv.lib.check.Pidfile()._check():
 
             boot_environment_root = zedenv.lib.be.root()
+            root_dataset = pyzfscmds.system.agnostic.mountpoint_dataset("/")
 
-            bootloader_set = zedenv.lib.be.get_property(
+            # Fetch every zedenv property once, for both the plugin and the generator
+            try:
+                zedenv_properties = zedenv_grub.zfs.Properties(
+                    [boot_environment_root, root_dataset])
+            except RuntimeError:
+                sys.exit(0)
+
+            bootloader_set = zedenv_properties.get(
                 boot_environment_root, "org.zedenv:bootloader")
 
             if bootloader_set:
@@ -814,7 +1415,6 @@ if __name__ == "__main__":
             else:
                 sys.exit(0)
 
-            root_dataset = pyzfscmds.system.agnostic.mountpoint_dataset("/")
             zpool = zedenv.lib.be.dataset_pool(root_dataset)
 
             current_be = None
@@ -832,11 +1432,22 @@ if __name__ == "__main__":
                 'noconfirm': False,
                 'noop': False,
                 'boot_environment_root': boot_environment_root
-            }, skip_update=True, skip_cleanup=True)
+            }, skip_update=True, skip_cleanup=True, properties=zedenv_properties)
+            bootloader_plugin.operation = "grub-mkconfig"
 
             if not bootloader_plugin.bootloader == "grub":
                 sys.exit(0)
 
+            # Reuse the entries generated last time if none of their inputs changed
+            generator_state = bootloader_plugin.fingerprint_state("generator")
+            if generator_state:
+                entries_fingerprint = bootloader_plugin.entries_fingerprint()
+                generated = generator_state.data.get("entries")
+                if entries_fingerprint and isinstance(generated, dict) and \
+                        generated.get("fingerprint") == entries_fingerprint:
+                    print(generated["section"], end="")
+                    sys.exit(0)
+
             try:
                 bootloader_plugin.post_activate()
             except (RuntimeWarning, RuntimeError, AttributeError) as err:
@@ -844,9 +1455,30 @@ if __name__ == "__main__":
             else:
                 ran_activate = True
 
-        for en in Generator().generate_grub_entries():
-            for l in en:
-                print(l)
+        # Write each entry as it is rendered, keeping it only if it is reused next time
+        keep_section = bool(generator_state)
+        section = []
+        for en in Generator(zedenv_properties).generate_grub_entries():
+            entry = "".join(f"{line}\n" for line in en)
+            sys.stdout.write(entry)
+            if keep_section:
+                section.append(entry)
 
         if ran_activate and bootloader_plugin:
             bootloader_plugin.teardown_boot_env_tree()
+
+        if generator_state:
+            # Taken after the work is done like GRUB.record_menu, so it describes
+            # the boot environments the entries were generated from
+            entries_fingerprint = bootloader_plugin.entries_fingerprint()
+
+        if generator_state and entries_fingerprint:
+            generator_state.data["entries"] = {
+                "fingerprint": entries_fingerprint,
+                "section": "".join(section)
+            }
+            generator_state.dirty = True
+            try:
+                generator_state.save()
+            except RuntimeError as e:
+                print(f"Warning: {e}", file=sys.stderr)
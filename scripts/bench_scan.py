@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Time how long the generator takes to scan the kernel directories of boot environments
+for a range of org.zedenv.grub:scanthreads values.
+
+A synthetic tree of boot environments is created in a temporary directory and used as
+org.zedenv.grub:boot. Listing each directory can be delayed to simulate freshly mounted
+datasets, which a warm tree in the page cache doesn't show.
+
+Needs zedenv and a ZFS root like the generator itself, run as root:
+
+    sudo python3 scripts/bench_scan.py --boot-environments 200 --latency 0 2 10
+"""
+
+import argparse
+import importlib.util
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import pyzfscmds.system.agnostic
+import zedenv.lib.be
+
+import zedenv_grub.zfs
+
+from typing import List
+
+GENERATOR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "grub.d", "05_zfs_linux.py")
+
+
+def load_generator():
+    spec = importlib.util.spec_from_file_location("zfs_linux", GENERATOR)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module.Generator
+
+
+def create_tree(boot: str, boot_environments: int, kernels: int):
+    """
+    Boot environments mounted for a boot directory on ZFS, as the plugin mounts them
+    """
+    for b in range(boot_environments):
+        boot_dir = os.path.join(boot, "zfsenv", f"zedenv-be{b}", "boot")
+        os.makedirs(boot_dir)
+
+        for k in range(kernels):
+            version = f"5.4.0-{40 + k}-generic"
+            for name in (f"vmlinuz-{version}", f"initrd.img-{version}"):
+                open(os.path.join(boot_dir, name), "w").close()
+            with open(os.path.join(boot_dir, f"config-{version}"), "w") as f:
+                f.write("CONFIG_FB_EFI=y\nCONFIG_VT_HW_CONSOLE_BINDING=y\n")
+
+
+def time_scan(generator, threads: int, latency: float, runs: int,
+              kernels: int) -> List[float]:
+    """
+    Time full scans, checking each finds every kernel
+    """
+    scandir = os.scandir
+
+    def slow_scandir(path):
+        time.sleep(latency)
+        return scandir(path)
+
+    generator.scan_threads = threads
+    if latency:
+        os.scandir = slow_scandir
+
+    times = []
+    try:
+        for _ in range(runs):
+            start = time.perf_counter()
+            entries = list(generator.get_boot_environments_boot_list())
+            times.append(time.perf_counter() - start)
+
+            # Not counting the kernels in /boot, which are scanned as well
+            found = sum(len(e["kernels"]) for e in entries
+                        if e["directory"].startswith(generator.boot_env_kernels))
+            if found != kernels:
+                sys.exit(f"Scan found {found} kernels instead of {kernels}.")
+    finally:
+        os.scandir = scandir
+
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--boot-environments", type=int, default=200)
+    parser.add_argument("--kernels", type=int, default=5,
+                        help="Kernels in each boot environment")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--latency", type=float, nargs="+", default=[0, 2, 10],
+                        help="Milliseconds added to listing each directory")
+    args = parser.parse_args()
+
+    if not pyzfscmds.system.agnostic.check_valid_system():
+        sys.exit("Needs a system with ZFS on root.")
+
+    generator_class = load_generator()
+
+    with tempfile.TemporaryDirectory() as boot:
+        create_tree(boot, args.boot_environments, args.kernels)
+
+        root_dataset = pyzfscmds.system.agnostic.mountpoint_dataset("/")
+        properties = zedenv_grub.zfs.Properties(
+            [root_dataset, zedenv.lib.be.root()],
+            [f"{root_dataset}\torg.zedenv.grub:boot\t{boot}",
+             f"{root_dataset}\torg.zedenv.grub:bootonzfs\tyes"])
+        generator = generator_class(properties)
+
+        print(f"{args.boot_environments} boot environments, {args.kernels} kernels each, "
+              f"median of {args.runs} runs")
+        print("latency  " + "".join(f"threads={t:<4}" for t in args.threads))
+
+        for latency in args.latency:
+            row = [statistics.median(time_scan(generator, t, latency / 1000, args.runs,
+                                               args.boot_environments * args.kernels))
+                   for t in args.threads]
+            print(f"{latency:>5g}ms  " + "".join(f"{t * 1000:>8.1f}ms  " for t in row))
+
+
+if __name__ == "__main__":
+    main()
@@ -48,6 +48,8 @@ setup(
     entry_points="""
         [zedenv.plugins]
         grub = zedenv_grub.grub:GRUB
+        [console_scripts]
+        zedenv-grub = zedenv_grub.cli:cli
     """,
     zip_safe=False,
     data_files=[("/etc/grub.d", ["grub.d/05_zfs_linux.py"])],
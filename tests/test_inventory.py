@@ -0,0 +1,91 @@
+"""
+Tests for the kernel inventories kept in a ZFS user property
+"""
+
+import json
+
+from typing import Optional
+
+import zedenv_grub.inventory
+from zedenv_grub.inventory import PROPERTY, decode, encode, fresh, stamp
+
+INVENTORY = {
+    "files": {"vmlinuz-5.4.0-42-generic": [9000000, 1600000000],
+              "config-5.4.0-42-generic": [230000, 1600000000]},
+    "configs": {"config-5.4.0-42-generic": {"CONFIG_FB_EFI": "y"}}
+}
+
+
+def boot_environment(value: str = "-", written: str = "0") -> dict:
+    """
+    A boot environment as zedenv_grub.zfs.BootEnvironments lists it
+    """
+    return {"name": "rpool/ROOT/a", "guid": "1234", "createtxg": "20", "written": written,
+            "referenced": "8192", "snapshottxg": "0", PROPERTY: value}
+
+
+class Store:
+    """
+    Stands in for InventoryCache
+    """
+
+    def __init__(self, inventory: Optional[dict] = None):
+        self.inventory = inventory
+
+    def get(self, be: dict) -> Optional[dict]:
+        return self.inventory
+
+
+def test_encode_decode():
+    value = encode(INVENTORY)
+
+    assert " " not in value
+    assert value == encode(json.loads(value))
+    assert decode(value) == INVENTORY
+
+
+def test_encode_too_long():
+    files = {f"vmlinuz-{i}": [i, i] for i in range(1000)}
+    assert encode({"files": files, "configs": {}}) is None
+
+
+def test_decode_invalid():
+    for value in (None, "", "-", "{", "[]", '{"files": {}}', '{"files": [], "configs": {}}'):
+        assert decode(value) is None
+
+
+def test_fresh():
+    be = boot_environment()
+    be[PROPERTY] = encode(dict(INVENTORY, stamp=stamp(be)))
+
+    assert fresh(be) == dict(INVENTORY, stamp=stamp(be))
+
+
+def test_stale_after_write():
+    be = boot_environment()
+    value = encode(dict(INVENTORY, stamp=stamp(be)))
+    written = boot_environment(value, written="4096")
+
+    assert fresh(written) is None
+    assert fresh(written, Store(INVENTORY)) == INVENTORY
+    assert fresh(boot_environment(), Store()) is None
+
+
+def test_property_before_store():
+    be = boot_environment()
+    be[PROPERTY] = encode(dict(INVENTORY, stamp=stamp(be)))
+
+    assert fresh(be, Store({"files": {}, "configs": {}}))["files"] == INVENTORY["files"]
+
+
+def test_scan(tmp_path):
+    (tmp_path / "vmlinuz-5.4.0-42-generic").write_bytes(b"\0" * 16)
+    (tmp_path / "config-5.4.0-42-generic").write_text(
+        "CONFIG_FB_EFI=y\n# CONFIG_VT_HW_CONSOLE_BINDING is not set\nCONFIG_ZFS=m\n")
+    (tmp_path / "grub").mkdir()
+
+    inventory = zedenv_grub.inventory.scan(str(tmp_path))
+
+    assert sorted(inventory["files"]) == ["config-5.4.0-42-generic", "vmlinuz-5.4.0-42-generic"]
+    assert inventory["files"]["vmlinuz-5.4.0-42-generic"][0] == 16
+    assert inventory["configs"] == {"config-5.4.0-42-generic": {"CONFIG_FB_EFI": "y"}}
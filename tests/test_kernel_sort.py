@@ -0,0 +1,174 @@
+"""
+Tests that kernels sort the same as with the comparator kernel_sort_key replaced
+"""
+
+import functools
+import importlib.util
+import os
+import random
+import re
+
+import pytest
+
+pytest.importorskip("zedenv")
+pytest.importorskip("pyzfscmds")
+
+GENERATOR = os.path.join(os.path.dirname(__file__), os.pardir, "grub.d", "05_zfs_linux.py")
+
+
+@pytest.fixture(scope="module")
+def generator():
+    spec = importlib.util.spec_from_file_location("zfs_linux", GENERATOR)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module.Generator
+
+
+class LooseVersion:
+    """
+    The parsing and comparison of distutils.version.LooseVersion,
+    which the old comparator used and which isn't in Python 3.12
+    """
+
+    component_re = re.compile(r'(\d+ | [a-z]+ | \.)', re.VERBOSE)
+
+    def __init__(self, vstring: str):
+        self.version = []
+        for component in self.component_re.split(vstring):
+            if component and component != '.':
+                try:
+                    component = int(component)
+                except ValueError:
+                    pass
+                self.version.append(component)
+
+    def __eq__(self, other):
+        return self.version == other.version
+
+    def __lt__(self, other):
+        return self.version < other.version
+
+
+def kernel_comparator(kernel0: str, kernel1: str) -> int:
+    """
+    Generator.kernel_comparator as it was before it was replaced by kernel_sort_key
+    """
+
+    regex = re.compile(r'-([0-9]+([\.|\-][0-9]+)*)-')
+
+    version0 = regex.search(kernel0)
+    version1 = regex.search(kernel1)
+
+    def ext_cmp(k0: str, k1: str) -> int:
+        """
+        Check if the kernels and in an extension,
+        if one of them does consider it less than the other
+        """
+        exts = ('bak', '.old')
+        if k0.endswith(exts) or k1.endswith(exts):
+            if k0.endswith(exts) and k1.endswith(exts):
+                return 0
+
+            if k0.endswith(exts):
+                return -1
+            return 1
+
+        return 0
+
+    # Compare versions
+    if version0 or version1:
+        if version0 and version1:
+            sv0 = -1
+            sv1 = -1
+            try:
+                sv0 = LooseVersion(version0.group(1))
+            except ValueError:
+                pass
+            try:
+                sv1 = LooseVersion(version1.group(1))
+            except ValueError:
+                pass
+
+            try:
+                if sv0 < sv1:
+                    return -1
+                if sv0 == sv1:
+                    return ext_cmp(kernel0, kernel1)
+                return 1
+            except AttributeError:
+                return ext_cmp(kernel0, kernel1)
+
+        if version0:
+            return 1
+        return -1
+
+    # No version
+    return ext_cmp(kernel0, kernel1)
+
+
+def sorted_both_ways(generator, kernels: list) -> tuple:
+    return (sorted(kernels, reverse=True, key=functools.cmp_to_key(kernel_comparator)),
+            sorted(kernels, reverse=True, key=generator.kernel_sort_key))
+
+
+def synthetic_kernels(count: int) -> list:
+    """
+    Kernel names whose versions LooseVersion can compare, which it can't
+    when one has '.' where another has '-'
+    """
+    rng = random.Random(8)
+    prefixes = ("vmlinuz", "vmlinux", "kernel")
+    suffixes = ("", ".old", "-bak", ".efi.bak")
+    flavours = ("generic", "lowmem", "lts", "zen")
+
+    kernels = []
+    for _ in range(count):
+        prefix = rng.choice(prefixes)
+        suffix = rng.choice(suffixes)
+        if rng.random() < 0.1:
+            kernels.append(f"{prefix}-{rng.choice(flavours)}{suffix}")
+            continue
+
+        release = ".".join(str(rng.randint(0, 20)) for _ in range(3))
+        if rng.random() < 0.7:
+            release = f"{release}-{rng.randint(0, 200)}"
+        kernels.append(f"{prefix}-{release}-{rng.choice(flavours)}{suffix}")
+
+    return kernels
+
+
+def test_backups_sort_before_their_kernel(generator):
+    kernels = ["vmlinuz-5.4.0-42-generic.old", "vmlinuz-5.4.0-42-generic",
+               "vmlinuz-5.4.0-42-genericbak", "vmlinuz-5.4.0-40-generic"]
+    old, new = sorted_both_ways(generator, kernels)
+
+    assert new == old
+    assert new[0] == "vmlinuz-5.4.0-42-generic"
+    assert new[-1] == "vmlinuz-5.4.0-40-generic"
+
+
+def test_unversioned_sort_after_versioned(generator):
+    kernels = ["vmlinuz-linux", "vmlinuz-4.19.0-1-amd64", "vmlinuz-linux-lts.old",
+               "vmlinuz-linux-lts", "vmlinuz-5.10.0-9-amd64"]
+    old, new = sorted_both_ways(generator, kernels)
+
+    assert new == old
+    assert new[:2] == ["vmlinuz-5.10.0-9-amd64", "vmlinuz-4.19.0-1-amd64"]
+    assert new[-1] == "vmlinuz-linux-lts.old"
+
+
+def test_numeric_components(generator):
+    kernels = ["vmlinuz-5.4.0-9-generic", "vmlinuz-5.4.0-10-generic", "vmlinuz-5.10-generic",
+               "vmlinuz-5.4-generic"]
+    old, new = sorted_both_ways(generator, kernels)
+
+    assert new == old
+    assert new == ["vmlinuz-5.10-generic", "vmlinuz-5.4.0-10-generic",
+                   "vmlinuz-5.4.0-9-generic", "vmlinuz-5.4-generic"]
+
+
+def test_same_order_as_old_comparator(generator):
+    old, new = sorted_both_ways(generator, synthetic_kernels(5000))
+
+    assert new == old
@@ -0,0 +1,128 @@
+"""
+Tests for editing the generated boot environment menu in place
+"""
+
+import zedenv_grub.menu
+
+ACTIVE = "rpool/ROOT/default"
+KERNEL = "5.4.0-42-generic"
+
+
+def entry(be: str, kind: str, indent: int = 1) -> list:
+    """
+    An entry as the generator writes it
+    """
+    tab = "\t" * indent
+    dataset = f"rpool/ROOT/{be}"
+    title = f"GNU/Linux BE [{be}] with Linux {KERNEL}"
+    if kind == "recovery":
+        title = f"{title} (recovery mode)"
+
+    return [
+        f"{tab}menuentry '{title}' --class gnu-linux --class gnu --class os "
+        f"$menuentry_id_option 'gnulinux-{KERNEL}-{kind}-{dataset}' {{",
+        f"{tab}\tinsmod zfs",
+        f"{tab}\techo 'Loading Linux {KERNEL} ...'",
+        f"{tab}\tlinux /ROOT/{be}@/boot/vmlinuz-{KERNEL} root=ZFS={dataset} rw "
+        f"{'single' if kind == 'recovery' else 'quiet'}",
+        f"{tab}\tinitrd /ROOT/{be}@/boot/initrd.img-{KERNEL}",
+        f"{tab}}}"
+    ]
+
+
+def menu(*boot_environments: str) -> str:
+    """
+    The active boot environment's entries at the top level, the others in a submenu
+    """
+    lines = entry("default", "advanced", indent=0)
+    lines.append(f"submenu 'Boot Environments (GNU/Linux)' $menuentry_id_option "
+                 f"'gnulinux-advanced-be-{ACTIVE}' {{")
+    for be in boot_environments:
+        lines.extend(entry(be, "advanced"))
+        lines.extend(entry(be, "recovery"))
+    lines.append("}")
+
+    return "".join(f"{line}\n" for line in lines)
+
+
+def test_blocks():
+    lines = menu("a", "b").splitlines()
+    blocks = zedenv_grub.menu.blocks(lines)
+
+    assert [(b.kind, b.entry_id) for b in blocks] == [
+        ("menuentry", f"gnulinux-{KERNEL}-advanced-{ACTIVE}"),
+        ("menuentry", f"gnulinux-{KERNEL}-advanced-rpool/ROOT/a"),
+        ("menuentry", f"gnulinux-{KERNEL}-recovery-rpool/ROOT/a"),
+        ("menuentry", f"gnulinux-{KERNEL}-advanced-rpool/ROOT/b"),
+        ("menuentry", f"gnulinux-{KERNEL}-recovery-rpool/ROOT/b"),
+        ("submenu", f"gnulinux-advanced-be-{ACTIVE}"),
+    ]
+    assert blocks[-1].start == 6 and blocks[-1].end == len(lines) - 1
+
+
+def test_unbalanced_braces():
+    lines = menu("a").splitlines()[:-1]
+    assert zedenv_grub.menu.blocks(lines) is None
+    assert zedenv_grub.menu.remove_entries("".join(f"{line}\n" for line in lines),
+                                           "rpool/ROOT/a") is None
+
+
+def test_remove_entries():
+    assert zedenv_grub.menu.remove_entries(menu("a", "b", "c"), "rpool/ROOT/b") == \
+        menu("a", "c")
+
+
+def test_remove_only_the_named_boot_environment():
+    # 'rpool/ROOT/a' is a prefix of 'rpool/ROOT/ab'
+    assert zedenv_grub.menu.remove_entries(menu("a", "ab"), "rpool/ROOT/a") == menu("ab")
+
+
+def test_remove_last_entries_of_submenu():
+    # A full rebuild wouldn't write an empty submenu
+    assert zedenv_grub.menu.remove_entries(menu("a"), "rpool/ROOT/a") is None
+
+
+def test_remove_active_or_unknown():
+    assert zedenv_grub.menu.remove_entries(menu("a", "b"), ACTIVE) is None
+    assert zedenv_grub.menu.remove_entries(menu("a", "b"), "rpool/ROOT/c") is None
+
+
+def test_rename_entries():
+    assert zedenv_grub.menu.rename_entries(
+        menu("a", "b"), "rpool/ROOT/b", "rpool/ROOT/c") == menu("a", "c")
+
+
+def test_rename_only_the_named_boot_environment():
+    renamed = zedenv_grub.menu.rename_entries(menu("a", "ab"), "rpool/ROOT/a", "rpool/ROOT/c")
+
+    assert renamed == menu("c", "ab")
+    assert "/ROOT/ab@/boot" in renamed and "ZFS=rpool/ROOT/ab " in renamed
+
+
+def test_rename_to_existing_active_or_unknown():
+    assert zedenv_grub.menu.rename_entries(
+        menu("a", "b"), "rpool/ROOT/a", "rpool/ROOT/b") is None
+    assert zedenv_grub.menu.rename_entries(
+        menu("a", "b"), ACTIVE, "rpool/ROOT/c") is None
+    assert zedenv_grub.menu.rename_entries(
+        menu("a", "b"), "rpool/ROOT/c", "rpool/ROOT/d") is None
+
+
+def test_rename_grubenv_default():
+    section = "".join(f"{line}\n" for line in zedenv_grub.menu.grubenv_default("rpool/ROOT/a"))
+    renamed = zedenv_grub.menu.rename_entries(
+        f"{section}{menu('a')}", "rpool/ROOT/a", "rpool/ROOT/c")
+
+    assert '    set default="gnulinux-simple-rpool/ROOT/c"\n' in renamed
+    assert "rpool/ROOT/a" not in renamed
+
+
+def test_has_grubenv_default():
+    lines = zedenv_grub.menu.grubenv_default(ACTIVE)
+    lines.append(f"menuentry 'GNU/Linux' $menuentry_id_option "
+                 f"'{zedenv_grub.menu.default_entry_id(ACTIVE)}' {{")
+    lines.append("}")
+
+    assert zedenv_grub.menu.has_grubenv_default(lines, ACTIVE)
+    assert not zedenv_grub.menu.has_grubenv_default(lines, "rpool/ROOT/a")
+    assert not zedenv_grub.menu.has_grubenv_default(menu("a").splitlines(), ACTIVE)
@@ -0,0 +1,151 @@
+"""
+Tests for regenerating only the zedenv section of grub.cfg
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import zedenv_grub.mkconfig
+from zedenv_grub.mkconfig import BEGIN_MARKER, END_MARKER
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+def grub_cfg(section: str) -> str:
+    return ("### BEGIN /etc/grub.d/00_header ###\nset timeout=5\n"
+            "### END /etc/grub.d/00_header ###\n\n"
+            f"{BEGIN_MARKER}\n{section}{END_MARKER}\n\n"
+            "### BEGIN /etc/grub.d/30_os-prober ###\n### END /etc/grub.d/30_os-prober ###\n")
+
+
+@pytest.fixture
+def environ():
+    """
+    Restore the environment GRUB defaults are sourced into
+    """
+    saved = dict(os.environ)
+    yield os.environ
+    os.environ.clear()
+    os.environ.update(saved)
+
+
+@pytest.fixture
+def defaults(tmp_path):
+    """
+    GRUB defaults with a setting /etc/default/grub.d overrides, like Ubuntu's cloud images do
+    """
+    grub = tmp_path / "grub"
+    grub.write_text('GRUB_CMDLINE_LINUX_DEFAULT="quiet splash"\nGRUB_TIMEOUT=5\n')
+
+    grub_d = tmp_path / "grub.d"
+    grub_d.mkdir()
+    (grub_d / "50-cloudimg-settings.cfg").write_text(
+        'GRUB_CMDLINE_LINUX_DEFAULT="console=tty1 console=ttyS0"\n')
+    (grub_d / "60-submenu.cfg").write_text('GRUB_DISABLE_SUBMENU="y"\n')
+    (grub_d / "README").write_text('GRUB_TIMEOUT=0\n')
+
+    return str(grub)
+
+
+def test_section():
+    section = "menuentry 'a' {\n}\nmenuentry 'b' {\n}\n"
+    assert zedenv_grub.mkconfig.section(grub_cfg(section)) == section
+
+
+def test_empty_section():
+    cfg = grub_cfg("")
+    bounds = zedenv_grub.mkconfig.section_bounds(cfg)
+
+    assert bounds[0] == bounds[1]
+    assert zedenv_grub.mkconfig.section(cfg) == ""
+
+
+def test_splice_keeps_the_rest():
+    cfg = grub_cfg("menuentry 'old' {\n}\n")
+    new_section = "menuentry 'new' {\n}\n"
+    spliced = zedenv_grub.mkconfig.splice(cfg, new_section)
+
+    assert spliced == grub_cfg(new_section)
+    assert zedenv_grub.mkconfig.section(spliced) == new_section
+    # Splicing an empty section and back restores the config
+    emptied = zedenv_grub.mkconfig.splice(cfg, "")
+    assert zedenv_grub.mkconfig.splice(emptied, "menuentry 'old' {\n}\n") == cfg
+
+
+@pytest.mark.parametrize("cfg", [
+    "set timeout=5\n",
+    f"{BEGIN_MARKER}\nmenuentry 'a' {{\n}}\n",
+    grub_cfg("") + grub_cfg(""),
+    f"set timeout=5\n{END_MARKER}\n{BEGIN_MARKER}\n",
+])
+def test_no_single_section(cfg):
+    assert zedenv_grub.mkconfig.section_bounds(cfg) is None
+    assert zedenv_grub.mkconfig.section(cfg) is None
+    assert zedenv_grub.mkconfig.splice(cfg, "menuentry 'a' {\n}\n") is None
+
+
+def test_defaults_files(defaults):
+    assert zedenv_grub.mkconfig.defaults_files(defaults) == [
+        defaults,
+        os.path.join(f"{defaults}.d", "50-cloudimg-settings.cfg"),
+        os.path.join(f"{defaults}.d", "60-submenu.cfg")
+    ]
+
+
+def test_grub_d_overrides_defaults(environ, defaults):
+    environ.pop("GRUB_DISABLE_SUBMENU", None)
+    zedenv_grub.mkconfig.source_defaults(defaults)
+
+    assert environ["GRUB_CMDLINE_LINUX_DEFAULT"] == "console=tty1 console=ttyS0"
+    assert environ["GRUB_DISABLE_SUBMENU"] == "y"
+    assert environ["GRUB_TIMEOUT"] == "5"
+
+
+def test_full_run_and_splice_generate_the_same_section(environ, defaults, tmp_path):
+    """
+    A generator that sources GRUB defaults like 05_zfs_linux.py generates the same
+    section in process as when grub-mkconfig runs it with the defaults it sourced
+    """
+    generator = tmp_path / "05_test.py"
+    generator.write_text(f"""
+import os
+import zedenv_grub.mkconfig
+
+
+class Generator:
+    def __init__(self):
+        zedenv_grub.mkconfig.source_defaults({defaults!r})
+
+    def generate_grub_entries(self):
+        yield ["menuentry 'Linux' {{",
+               f"\\tlinux /vmlinuz {{os.environ.get('GRUB_CMDLINE_LINUX_DEFAULT', '')}}",
+               "}}"]
+        if os.environ.get("GRUB_DISABLE_SUBMENU") != "y":
+            yield ["submenu 'Advanced' {{", "}}"]
+
+
+if __name__ == "__main__":
+    for entry in Generator().generate_grub_entries():
+        for line in entry:
+            print(line)
+""")
+
+    for key in ("GRUB_CMDLINE_LINUX_DEFAULT", "GRUB_DISABLE_SUBMENU"):
+        environ.pop(key, None)
+    environ["PYTHONPATH"] = REPO
+
+    # What grub-mkconfig does before running the scripts in /etc/grub.d
+    full_run = subprocess.check_output(
+        ["sh", "-c", f'. "$1"; for x in "$1".d/*.cfg; do . "$x"; done; '
+                     f'export GRUB_CMDLINE_LINUX_DEFAULT GRUB_DISABLE_SUBMENU; '
+                     f'exec "{sys.executable}" "$2"', "sh", defaults, str(generator)],
+        universal_newlines=True)
+
+    spliced = zedenv_grub.mkconfig.generate_section(str(generator))
+
+    assert spliced == full_run
+    assert "\tlinux /vmlinuz console=tty1 console=ttyS0\n" in spliced
+    assert "submenu" not in spliced
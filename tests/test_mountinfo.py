@@ -0,0 +1,74 @@
+"""
+Tests for translating kernel paths from the mount table
+"""
+
+import os
+
+import pytest
+
+from zedenv_grub.mountinfo import MountInfo, unescape
+
+
+@pytest.fixture
+def mounts(tmp_path):
+    """
+    A mount table with boot environments mounted under a temporary directory
+    """
+    base = os.path.realpath(str(tmp_path))
+    for directory in ("be/boot", "be two/boot", "bind/boot", "ext4/boot", "stacked/boot"):
+        os.makedirs(os.path.join(base, directory))
+    escaped = base.replace(" ", "\\040")
+
+    mountinfo = tmp_path / "mountinfo"
+    mountinfo.write_text("\n".join([
+        "22 1 0:21 / / rw,relatime shared:1 - zfs rpool/ROOT/default rw,xattr,posixacl",
+        f"30 22 0:30 / {escaped}/be rw,relatime shared:9 - zfs rpool/ROOT/a rw,xattr",
+        f"31 22 0:31 / {escaped}/be\\040two rw,relatime - zfs rpool/ROOT/b\\040c rw,xattr",
+        f"32 22 0:30 /boot {escaped}/bind rw,relatime - zfs rpool/ROOT/a rw,xattr",
+        f"33 22 8:1 / {escaped}/ext4 rw,relatime - ext4 /dev/sda1 rw",
+        f"34 22 0:32 / {escaped}/stacked rw,relatime - ext4 /dev/sda2 rw",
+        f"35 34 0:33 / {escaped}/stacked rw,relatime - zfs bpool/BOOT/a rw,xattr",
+        "not a mountinfo line",
+    ]) + "\n")
+
+    return base, MountInfo(str(mountinfo))
+
+
+def test_unescape():
+    assert unescape("/mnt/be\\040two\\011tab\\134") == "/mnt/be two\ttab\\"
+
+
+def test_zfs_relpath(mounts):
+    base, mountinfo = mounts
+
+    assert mountinfo.zfs_relpath(os.path.join(base, "be/boot")) == "/ROOT/a@/boot"
+    assert mountinfo.zfs_relpath(os.path.join(base, "be")) == "/ROOT/a@"
+    assert mountinfo.zfs_relpath(os.path.join(base, "be two/boot")) == "/ROOT/b c@/boot"
+
+
+def test_zfs_relpath_follows_symlinks(mounts):
+    base, mountinfo = mounts
+    os.symlink(os.path.join(base, "be/boot"), os.path.join(base, "link"))
+
+    assert mountinfo.zfs_relpath(os.path.join(base, "link")) == "/ROOT/a@/boot"
+
+
+def test_zfs_relpath_later_mount_hides_earlier(mounts):
+    base, mountinfo = mounts
+
+    assert mountinfo.zfs_relpath(os.path.join(base, "stacked/boot")) == "/BOOT/a@/boot"
+
+
+def test_zfs_relpath_not_plain_zfs(mounts):
+    base, mountinfo = mounts
+
+    # Bind mounts of a subdirectory and other filesystems are left to grub-mkrelpath
+    assert mountinfo.zfs_relpath(os.path.join(base, "bind/boot")) is None
+    assert mountinfo.zfs_relpath(os.path.join(base, "ext4/boot")) is None
+
+
+def test_missing_mountinfo(tmp_path):
+    mountinfo = MountInfo(str(tmp_path / "missing"))
+
+    assert mountinfo.mounts == {}
+    assert mountinfo.zfs_relpath(str(tmp_path)) is None
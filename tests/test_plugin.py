@@ -0,0 +1,177 @@
+"""
+Tests for when the plugin edits the GRUB menu instead of regenerating it
+"""
+
+import os
+
+import pytest
+
+pytest.importorskip("zedenv")
+
+import zedenv.lib.be  # noqa: E402
+
+import zedenv_grub.cache  # noqa: E402
+import zedenv_grub.grub  # noqa: E402
+import zedenv_grub.menu  # noqa: E402
+from zedenv_grub.mkconfig import BEGIN_MARKER, END_MARKER  # noqa: E402
+
+BE_ROOT = "rpool/ROOT"
+KERNEL = "5.4.0-42-generic"
+
+
+def entry(be: str, indent: str = "\t") -> str:
+    dataset = f"{BE_ROOT}/{be}"
+    return (f"{indent}menuentry 'GNU/Linux BE [{be}] with Linux {KERNEL}' "
+            f"$menuentry_id_option 'gnulinux-{KERNEL}-advanced-{dataset}' {{\n"
+            f"{indent}\tlinux /ROOT/{be}@/boot/vmlinuz-{KERNEL} root=ZFS={dataset} rw\n"
+            f"{indent}}}\n")
+
+
+def simple_entry(be: str) -> str:
+    dataset = f"{BE_ROOT}/{be}"
+    return (f"menuentry 'GNU/Linux BE [{be}]' $menuentry_id_option "
+            f"'{zedenv_grub.menu.default_entry_id(dataset)}' {{\n"
+            f"\tlinux /ROOT/{be}@/boot/vmlinuz-{KERNEL} root=ZFS={dataset} rw\n}}\n")
+
+
+def grubenv_cfg(*boot_environments: str) -> str:
+    """
+    A menu generated with activation=grubenv
+    """
+    default = "".join(f"{line}\n" for line in zedenv_grub.menu.grubenv_default(
+        f"{BE_ROOT}/{boot_environments[0]}"))
+    return (f"set timeout=5\n{BEGIN_MARKER}\n{default}"
+            f"{''.join(simple_entry(be) for be in boot_environments)}{END_MARKER}\n")
+
+
+def grub_cfg(*boot_environments: str) -> str:
+    """
+    The active boot environment 'default' at the top level, the others in a submenu
+    """
+    return (f"set timeout=5\n{BEGIN_MARKER}\n{entry('default', indent='')}"
+            f"submenu 'Boot Environments (GNU/Linux)' $menuentry_id_option "
+            f"'gnulinux-advanced-be-{BE_ROOT}/default' {{\n"
+            f"{''.join(entry(be) for be in boot_environments)}}}\n{END_MARKER}\n")
+
+
+class Plugin(zedenv_grub.grub.GRUB):
+    """
+    The plugin without the system it configures, recording what it would change
+    """
+
+    def __init__(self, grub_cfg_path: str, **properties):
+        self.zedenv_properties = {
+            p["property"]: p["default"] for p in self.allowed_properties}
+        self.zedenv_properties.update(properties)
+
+        self.verbose = False
+        self.noop = False
+        self.skip_update_grub = False
+        self.skip_cleanup = False
+        self.bootonzfs = True
+        self.grubenv_activation = self.zedenv_properties["activation"] == "grubenv"
+        self.be_root = BE_ROOT
+        self.boot_environment = "default"
+        self.old_boot_environment = "default"
+        self.operation = "activate"
+        self.grub_cfg_path = grub_cfg_path
+
+        self.regenerated = False
+        self.saved_entry = None
+        # What each boot environment's entries would be generated from now
+        self.stamps = {}
+
+    def release_boot_environment_mounts(self, be: str):
+        pass
+
+    def setup_boot_env_tree(self):
+        pass
+
+    def teardown_boot_env_tree(self):
+        pass
+
+    def grub_mkconfig(self, location: str):
+        self.regenerated = True
+
+    def select_default_entry(self) -> bool:
+        self.saved_entry = zedenv_grub.menu.default_entry_id(self.default_dataset())
+        return True
+
+    def entry_stamps(self) -> dict:
+        return dict(self.stamps)
+
+    def entries_state(self) -> zedenv_grub.cache.Cache:
+        return zedenv_grub.cache.Cache("grubenv", os.path.dirname(self.grub_cfg_path))
+
+
+@pytest.fixture
+def cfg(tmp_path, monkeypatch):
+    monkeypatch.setattr(zedenv.lib.be, "extra_bpool", lambda: False)
+    monkeypatch.setattr(zedenv.lib.be, "bootfs_for_pool", lambda pool: f"{BE_ROOT}/default")
+
+    path = tmp_path / "grub.cfg"
+    path.write_text(grub_cfg("a", "b", "c"))
+    return path
+
+
+def test_destroy_edits_menu(cfg):
+    plugin = Plugin(str(cfg))
+    plugin.post_destroy("b")
+
+    assert not plugin.regenerated
+    assert cfg.read_text() == grub_cfg("a", "c")
+
+
+@pytest.mark.parametrize("properties", [{"maxentries": "3"}, {"maxage": "30"}])
+def test_destroy_with_retention_regenerates(cfg, properties):
+    """
+    The menu may have left out a boot environment that now has room in it
+    """
+    plugin = Plugin(str(cfg), **properties)
+    plugin.post_destroy("b")
+
+    assert plugin.regenerated
+    assert cfg.read_text() == grub_cfg("a", "b", "c")
+
+
+@pytest.fixture
+def grubenv_plugin(tmp_path, monkeypatch):
+    monkeypatch.setattr(zedenv.lib.be, "extra_bpool", lambda: False)
+
+    path = tmp_path / "grub.cfg"
+    path.write_text(grubenv_cfg("default", "a"))
+
+    plugin = Plugin(str(path), activation="grubenv")
+    plugin.stamps = {f"{BE_ROOT}/default": "1", f"{BE_ROOT}/a": "1"}
+    return plugin
+
+
+def test_activate_in_grubenv_menu(grubenv_plugin):
+    grubenv_plugin.boot_environment = "a"
+
+    # Nothing records what the menu was generated from yet
+    grubenv_plugin.post_activate()
+    assert grubenv_plugin.regenerated
+
+    grubenv_plugin.regenerated = False
+    grubenv_plugin.post_activate()
+    assert not grubenv_plugin.regenerated
+    assert grubenv_plugin.saved_entry == f"gnulinux-simple-{BE_ROOT}/a"
+
+
+def test_activate_after_kernel_upgrade_regenerates(grubenv_plugin):
+    grubenv_plugin.post_activate()
+    grubenv_plugin.regenerated = False
+
+    # The kernels of 'a' changed since its entry was generated
+    grubenv_plugin.stamps[f"{BE_ROOT}/a"] = "2"
+    grubenv_plugin.boot_environment = "a"
+    grubenv_plugin.post_activate()
+
+    assert grubenv_plugin.regenerated
+    assert grubenv_plugin.saved_entry == f"gnulinux-simple-{BE_ROOT}/a"
+
+    # Recorded again with the menu
+    grubenv_plugin.regenerated = False
+    grubenv_plugin.post_activate()
+    assert not grubenv_plugin.regenerated
@@ -0,0 +1,128 @@
+"""
+Tests for answering grub-probe targets from pool metadata
+"""
+
+import pytest
+
+import zedenv_grub.resolver
+import zedenv_grub.zfs
+
+BPOOL_GUID = 1288391582713921390
+RPOOL_GUID = 0x2a
+
+
+def zpool_get() -> list:
+    return [
+        f"bpool\tguid\t{BPOOL_GUID}",
+        "bpool\tbootfs\t-",
+        f"rpool\tguid\t{RPOOL_GUID}",
+        "rpool\tbootfs\trpool/ROOT/default",
+    ]
+
+
+def zpool_status(bpool_devices: list, rpool_devices: list) -> list:
+    status = []
+    for pool, devices in (("bpool", bpool_devices), ("rpool", rpool_devices)):
+        status.extend([
+            f"  pool: {pool}",
+            " state: ONLINE",
+            "config:",
+            "",
+            "\tNAME        STATE     READ WRITE CKSUM",
+            f"\t{pool}       ONLINE       0     0     0",
+            "\t  mirror-0  ONLINE       0     0     0",
+            *(f"\t    {d}  ONLINE       0     0     0" for d in devices),
+            "",
+            "errors: No known data errors",
+            ""
+        ])
+
+    return status
+
+
+@pytest.fixture
+def devices(tmp_path):
+    """
+    Device nodes of whole disk partitions, and names of device-mapper
+    and md devices that resolve to them like the ones in /dev do
+    """
+    for name in ("sda2", "sdb2", "sda3", "sdb3", "dm-0", "md0"):
+        (tmp_path / name).touch()
+    (tmp_path / "mapper-crypt").symlink_to(tmp_path / "dm-0")
+
+    return {name: str(tmp_path / name)
+            for name in ("sda2", "sdb2", "sda3", "sdb3", "mapper-crypt", "md0")}
+
+
+@pytest.fixture
+def resolver(devices):
+    pools = zedenv_grub.zfs.Pools(
+        get_lines=zpool_get(),
+        status_lines=zpool_status([devices["sda2"], devices["sdb2"]],
+                                  [devices["sda3"], devices["mapper-crypt"]]))
+
+    return zedenv_grub.resolver.ZFSResolver(pools)
+
+
+def test_pools_from_fixture_output(devices):
+    pools = zedenv_grub.zfs.Pools(
+        get_lines=zpool_get(),
+        status_lines=zpool_status([devices["sda2"]], [devices["sda3"]]))
+
+    assert pools.guids == {"bpool": BPOOL_GUID, "rpool": RPOOL_GUID}
+    assert pools.bootfs == {"bpool": "-", "rpool": "rpool/ROOT/default"}
+    assert pools.vdevs == {"bpool": [devices["sda2"]], "rpool": [devices["sda3"]]}
+
+
+def test_fs(resolver, devices):
+    assert resolver.resolve("fs", [devices["sda2"]]) == ["zfs"]
+    assert resolver.resolve("fs", [devices["sda2"], devices["sdb2"]]) == ["zfs"]
+
+
+def test_fs_uuid(resolver, devices):
+    assert resolver.resolve("fs_uuid", [devices["sda2"]]) == [f"{BPOOL_GUID:016x}"]
+    # Padded to 16 hex digits like grub-probe prints it
+    assert resolver.resolve("fs_uuid", [devices["sda3"]]) == ["000000000000002a"]
+
+
+def test_plain_devices_need_no_modules(resolver, devices):
+    assert resolver.resolve("abstraction", [devices["sda2"], devices["sdb2"]]) == []
+    assert resolver.resolve("cryptodisk_uuid", [devices["sda2"]]) == []
+
+
+def test_device_mapper_falls_back_to_grub_probe(resolver, devices):
+    # rpool has a vdev on a device-mapper device
+    assert resolver.resolve("abstraction", [devices["sda3"]]) is None
+    assert resolver.resolve("cryptodisk_uuid", [devices["mapper-crypt"]]) is None
+
+    # The pool is still known
+    assert resolver.resolve("fs", [devices["mapper-crypt"]]) == ["zfs"]
+
+
+def test_md_falls_back_to_grub_probe(devices):
+    pools = zedenv_grub.zfs.Pools(
+        get_lines=zpool_get(),
+        status_lines=zpool_status([devices["md0"]], [devices["sda3"]]))
+    resolver = zedenv_grub.resolver.ZFSResolver(pools)
+
+    assert resolver.resolve("abstraction", [devices["md0"]]) is None
+    assert resolver.resolve("cryptodisk_uuid", [devices["md0"]]) is None
+
+
+def test_unknown_devices_fall_back_to_grub_probe(resolver, devices):
+    # Not a vdev of any pool
+    assert resolver.resolve("fs", [devices["sdb3"]]) is None
+    # Vdevs of different pools
+    assert resolver.resolve("fs_uuid", [devices["sda2"], devices["sda3"]]) is None
+    # Targets that aren't answered from pool metadata
+    assert resolver.resolve("partmap", [devices["sda2"]]) is None
+    assert resolver.resolve("fs", []) is None
+
+
+def test_pool_without_guid_falls_back_to_grub_probe(devices):
+    pools = zedenv_grub.zfs.Pools(
+        get_lines=[],
+        status_lines=zpool_status([devices["sda2"]], [devices["sda3"]]))
+    resolver = zedenv_grub.resolver.ZFSResolver(pools)
+
+    assert resolver.resolve("fs", [devices["sda2"]]) is None
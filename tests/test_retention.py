@@ -0,0 +1,76 @@
+"""
+Tests for which boot environments the menu keeps when there are too many
+"""
+
+from typing import Optional
+
+from zedenv_grub.retention import Policy, SECONDS_PER_DAY
+from zedenv_grub.zfs import BootEnvironments
+
+BE_ROOT = "rpool/ROOT"
+NOW = 1600000000
+
+
+def row(name: str, createtxg: int, age: float, mounted: bool = False) -> str:
+    """
+    A boot environment as 'zfs list' prints it, created 'age' days before NOW
+    """
+    return "\t".join([
+        f"{BE_ROOT}/{name}", "/" if mounted else "/mnt", "noauto",
+        "yes" if mounted else "no", "1234", str(createtxg),
+        str(int(NOW - age * SECONDS_PER_DAY)), "0", "8192", "-"])
+
+
+def boot_environments(root_dataset: Optional[str] = None) -> BootEnvironments:
+    """
+    'default' is mounted at '/' and the oldest, 'e' the newest
+    """
+    return BootEnvironments(BE_ROOT, list_lines=[
+        "\t".join([BE_ROOT, "none", "off", "no", "1", "1", str(NOW), "0", "0", "-"]),
+        row("default", 10, 60, mounted=True),
+        row("a", 20, 40),
+        row("b", 30, 20),
+        f"{BE_ROOT}/b@snap\t-\t-\t-\t5678\t35\t{NOW}\t0\t0\t-",
+        row("c", 40, 10),
+        row("d", 50, 5),
+        row("e", 60, 1),
+    ], root_dataset=root_dataset)
+
+
+def test_no_limits():
+    assert Policy().retained(boot_environments(), now=NOW) is None
+    assert Policy(keep=(f"{BE_ROOT}/a",)).retained(boot_environments(), now=NOW) is None
+
+
+def test_max_count():
+    assert Policy(max_count=2).retained(boot_environments(), now=NOW) == \
+        {"e", "d", "default"}
+
+
+def test_max_age():
+    assert Policy(max_age=15).retained(boot_environments(), now=NOW) == \
+        {"e", "d", "c", "default"}
+
+
+def test_max_count_and_age():
+    assert Policy(max_count=5, max_age=30).retained(boot_environments(), now=NOW) == \
+        {"e", "d", "c", "b", "default"}
+    assert Policy(max_count=1, max_age=30).retained(boot_environments(), now=NOW) == \
+        {"e", "default"}
+
+
+def test_keep():
+    policy = Policy(max_count=1, keep=(f"{BE_ROOT}/a",))
+    assert policy.retained(boot_environments(), now=NOW) == {"e", "a", "default"}
+
+
+def test_root_dataset():
+    # Kept by name when '/' isn't a mountpoint 'zfs list' reports, as in a chroot
+    assert Policy(max_count=1).retained(
+        boot_environments(root_dataset=f"{BE_ROOT}/b"), now=NOW) == {"e", "b"}
+
+
+def test_unparsable_creation():
+    lines = [row("a", 20, 1), row("b", 30, 1).replace("\t30\t", "\t-\t")]
+    assert Policy(max_count=1).retained(BootEnvironments(BE_ROOT, list_lines=lines),
+                                        now=NOW) == {"a"}
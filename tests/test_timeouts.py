@@ -0,0 +1,75 @@
+"""
+Tests for the time limits on grub-probe and grub-mkrelpath
+"""
+
+import importlib.util
+import os
+import time
+import types
+
+import pytest
+
+pytest.importorskip("zedenv")
+pytest.importorskip("pyzfscmds")
+
+GENERATOR = os.path.join(os.path.dirname(__file__), os.pardir, "grub.d", "05_zfs_linux.py")
+
+
+@pytest.fixture(scope="module")
+def generator():
+    spec = importlib.util.spec_from_file_location("zfs_linux", GENERATOR)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+@pytest.fixture
+def grub_probe(tmp_path, monkeypatch):
+    """
+    A grub-probe that answers 'fs' at once and hangs on every other target
+    """
+    probe = tmp_path / "grub-probe"
+    probe.write_text('#!/bin/sh\ncase "$*" in\n  *--target=fs) echo zfs;;\n'
+                     '  *) exec sleep 10;;\nesac\n')
+    probe.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_budget_only_counts_commands(generator):
+    deadline = generator.Deadline(call_timeout=None, run_budget=1)
+    time.sleep(0.2)
+    assert deadline.timeout() == 1
+
+    generator.grub_command("sleep", ["0.2"], deadline=deadline)
+    assert 0.5 < deadline.timeout() <= 0.8
+
+
+def test_budget_used_up(generator):
+    deadline = generator.Deadline(call_timeout=None, run_budget=0.2)
+
+    with pytest.raises(generator.CommandTimeout):
+        generator.grub_command("sleep", ["10"], deadline=deadline)
+    with pytest.raises(generator.CommandTimeout, match="No time left"):
+        generator.grub_command("true", deadline=deadline)
+
+
+def test_probe_timeout_fails_the_run(generator, grub_probe):
+    probe = generator.GrubProbe(deadline=generator.Deadline(call_timeout=0.2))
+    entry = types.SimpleNamespace(grub_probe=probe)
+
+    assert generator.GrubLinuxEntry.probe_devices(entry, "fs", ["/dev/sda2"]) == ["zfs"]
+    with pytest.raises(SystemExit, match="abstraction"):
+        generator.GrubLinuxEntry.probe_devices(entry, "abstraction", ["/dev/sda2"])
+
+
+def test_probe_failure_is_skipped(generator, tmp_path, monkeypatch):
+    probe = tmp_path / "grub-probe"
+    probe.write_text("#!/bin/sh\nexit 1\n")
+    probe.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+    entry = types.SimpleNamespace(grub_probe=generator.GrubProbe())
+
+    # Such as an abstraction grub-probe doesn't support, the entry just doesn't load it
+    assert generator.GrubLinuxEntry.probe_devices(entry, "abstraction", ["/dev/sda2"]) is None
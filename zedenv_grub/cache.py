@@ -0,0 +1,128 @@
+"""
+Persistent state kept between zedenv-grub runs
+"""
+
+import json
+import os
+import tempfile
+
+CACHE_DIR = "/var/cache/zedenv-grub"
+
+
+class Cache:
+    """
+    A JSON document stored under the cache directory.
+    Unreadable or corrupt cache files are treated as empty.
+    """
+
+    def __init__(self, name: str, cache_dir: str = CACHE_DIR):
+        self.name = name
+        self.path = os.path.join(cache_dir, f"{name}.json")
+        self.data = self.load()
+        self.dirty = False
+
+    def load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        return data if isinstance(data, dict) else {}
+
+    def save(self):
+        """
+        Atomically replace the cache file if anything changed
+        """
+        if not self.dirty:
+            return
+
+        cache_dir = os.path.dirname(self.path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix=f".{self.name}")
+        except OSError as e:
+            raise RuntimeError(f"Failed to write cache {self.path}.\n{e}")
+
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.data, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise RuntimeError(f"Failed to write cache {self.path}.\n{e}")
+
+        self.dirty = False
+
+    def flush(self):
+        self.data = {}
+        self.dirty = False
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise RuntimeError(f"Failed to remove cache {self.path}.\n{e}")
+
+
+class AnswerCache(Cache):
+    """
+    Command output keyed by the command's arguments
+    """
+
+    def __init__(self, name: str, cache_dir: str = CACHE_DIR):
+        super().__init__(name, cache_dir)
+
+        if not isinstance(self.data.get("answers"), dict):
+            self.data["answers"] = {}
+
+    @staticmethod
+    def answer_key(key: tuple) -> str:
+        return json.dumps(key)
+
+    def get(self, key: tuple):
+        return self.data["answers"].get(self.answer_key(key))
+
+    def set(self, key: tuple, answer):
+        answer_key = self.answer_key(key)
+        if self.data["answers"].get(answer_key) != answer:
+            self.data["answers"][answer_key] = answer
+            self.dirty = True
+
+
+class ProbeCache(AnswerCache):
+    """
+    grub-probe answers, only valid while the fingerprint of the
+    pool layout, encryption state and boot device is unchanged
+    """
+
+    def __init__(self, fingerprint: str, cache_dir: str = CACHE_DIR):
+        super().__init__("probe", cache_dir)
+
+        if self.data.get("fingerprint") != fingerprint:
+            self.data = {"fingerprint": fingerprint, "answers": {}}
+            self.dirty = True
+
+
+class LastGoodCache(AnswerCache):
+    """
+    The last successful answer to every command, used when a command
+    runs out of time. Keys answered from here are collected in 'stale'.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR):
+        super().__init__("lastgood", cache_dir)
+        self.stale = []
+
+    def fallback(self, key: tuple):
+        answer = self.get(key)
+        if answer is not None:
+            self.stale.append(key)
+
+        return answer
+
+
+CACHES = ("probe", "lastgood", "kernelconfig", "inventory", "mkconfig", "menu", "generator")
@@ -0,0 +1,126 @@
+"""
+Maintenance commands for the zedenv GRUB plugin
+"""
+
+import json
+import os
+
+import click
+
+import zedenv_grub.cache
+import zedenv_grub.mounts
+import zedenv_grub.resolver
+import zedenv_grub.zfs
+
+
+@click.group()
+def cli():
+    """zedenv GRUB plugin maintenance."""
+
+
+@cli.group()
+def cache():
+    """Inspect or flush persistent caches."""
+
+
+def selected_caches(name: str):
+    names = (name,) if name else zedenv_grub.cache.CACHES
+    return [zedenv_grub.cache.Cache(n) for n in names]
+
+
+@cache.command("show")
+@click.argument("name", required=False, type=click.Choice(zedenv_grub.cache.CACHES))
+def cache_show(name):
+    """Show cached data."""
+    for c in selected_caches(name):
+        click.echo(f"{c.name}: {c.path}")
+        if c.data:
+            click.echo(json.dumps(c.data, indent=2, sort_keys=True))
+        else:
+            click.echo("(empty)")
+
+
+@cache.command("flush")
+@click.argument("name", required=False, type=click.Choice(zedenv_grub.cache.CACHES))
+def cache_flush(name):
+    """Remove cached data."""
+    for c in selected_caches(name):
+        try:
+            c.flush()
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo(f"Flushed {c.name} cache.")
+
+
+@cli.group()
+def probe():
+    """Native grub-probe replacement."""
+
+
+@probe.command("verify")
+@click.argument("paths", nargs=-1)
+def probe_verify(paths):
+    """Compare native ZFS answers with grub-probe for the devices backing PATHS."""
+    os.environ['ZPOOL_VDEV_NAME_PATH'] = '1'
+
+    try:
+        resolver = zedenv_grub.resolver.ZFSResolver(zedenv_grub.zfs.Pools())
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+    mismatched = False
+    for path in paths or ("/",):
+        try:
+            devices = zedenv_grub.resolver.grub_probe(["--target=device", path])
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+
+        if not resolver.devices_pool(devices):
+            click.echo(f"{path}: not on ZFS, grub-probe is used.")
+            continue
+
+        mismatches = resolver.verify(devices)
+        for target, native, probed in mismatches:
+            click.echo(f"{path}: {target} differs, native {native}, grub-probe {probed}")
+
+        if mismatches:
+            mismatched = True
+        else:
+            click.echo(f"{path}: native answers match grub-probe.")
+
+    if mismatched:
+        raise click.ClickException("Native answers differ from grub-probe.")
+
+
+@cli.group()
+def mounts():
+    """Boot environment mounts kept between runs."""
+
+
+@mounts.command("show")
+def mounts_show():
+    """Show mounts kept between runs and what holds them."""
+    state = zedenv_grub.mounts.MountState()
+    state.prune()
+
+    if not state.mounts:
+        click.echo("(none)")
+    for mount_path, mount in sorted(state.mounts.items()):
+        click.echo(f"{mount_path}: {mount['dataset']} held by {', '.join(mount['holders'])}")
+
+
+@mounts.command("cleanup")
+def mounts_cleanup():
+    """Unmount every boot environment kept mounted between runs."""
+    state = zedenv_grub.mounts.MountState()
+    try:
+        errors = state.cleanup()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+    for e in errors:
+        click.echo(e, err=True)
+
+    if errors:
+        raise click.ClickException("Some boot environments are still mounted.")
+    click.echo("Unmounted all boot environments kept between runs.")
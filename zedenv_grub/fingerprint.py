@@ -0,0 +1,107 @@
+"""
+Fingerprint of everything the generated boot environment menu depends on
+"""
+
+import hashlib
+import json
+import os
+
+import zedenv_grub.inventory
+import zedenv_grub.mkconfig
+import zedenv_grub.retention
+import zedenv_grub.zfs
+
+from typing import List, Optional
+
+
+def kernel_dirs(boot: str, boot_on_zfs: bool) -> List[str]:
+    """
+    Directories whose kernels aren't covered by a boot environment's change stamp:
+    the root boot environment's /boot, or every kernel directory when /boot isn't on ZFS
+    """
+    if boot_on_zfs:
+        return ["/boot"]
+
+    env_dir = os.path.join(boot, "env")
+    try:
+        return ["/boot", *sorted(os.path.join(env_dir, d) for d in os.listdir(env_dir))]
+    except OSError:
+        return ["/boot"]
+
+
+def boot_environment_stamps(be_root: str, root_dataset: Optional[str] = None,
+                            policy: Optional[zedenv_grub.retention.Policy] = None) -> dict:
+    """
+    Get the change stamps of the boot environments the menu keeps
+    """
+    boot_environments = zedenv_grub.zfs.BootEnvironments(be_root, root_dataset=root_dataset)
+    retained = policy.retained(boot_environments) if policy else None
+
+    # The root boot environment changes all the time, its kernels are in kernel_dirs()
+    return {
+        be["name"]: be["guid"] if boot_environments.is_root(be)
+        else zedenv_grub.inventory.stamp(be)
+        for be_name, be in boot_environments.table.items()
+        if retained is None or be_name in retained
+    }
+
+
+def entry_stamps(be_root: str, root_dataset: Optional[str], boot: str, boot_on_zfs: bool,
+                 boot_pool_root: Optional[str] = None) -> dict:
+    """
+    Fingerprint what each boot environment's entries are generated from, by dataset:
+    its change stamp, the kernels that doesn't cover, GRUB defaults and the generator.
+    Raises RuntimeError if ZFS can't be queried.
+    """
+    stamps = boot_environment_stamps(be_root, root_dataset)
+    boot_pool = boot_environment_stamps(boot_pool_root) if boot_pool_root else {}
+    shared_input = {
+        "defaults": zedenv_grub.mkconfig.path_stats(zedenv_grub.mkconfig.defaults_files()),
+        "generator": zedenv_grub.mkconfig.path_stats([zedenv_grub.mkconfig.GENERATOR])
+    }
+
+    entries = {}
+    for dataset, stamp in stamps.items():
+        be_name = dataset.rsplit("/", 1)[-1]
+
+        boot_dirs = ["/boot"] if dataset == root_dataset else []
+        if not boot_on_zfs:
+            boot_dirs.append(os.path.join(boot, "env", f"zedenv-{be_name}"))
+
+        fingerprint_input = dict(
+            shared_input, boot_environment=stamp,
+            boot_pool=boot_pool.get(f"{boot_pool_root}/{be_name}"),
+            kernels=[zedenv_grub.mkconfig.dir_stats(d) for d in boot_dirs])
+        entries[dataset] = hashlib.sha256(
+            json.dumps(fingerprint_input, sort_keys=True).encode()).hexdigest()
+
+    return entries
+
+
+def menu_fingerprint(be_root: str, root_dataset: Optional[str], boot_dirs: List[str],
+                     properties: Optional[zedenv_grub.zfs.Properties] = None,
+                     boot_pool_root: Optional[str] = None,
+                     policy: Optional[zedenv_grub.retention.Policy] = None) -> str:
+    """
+    Fingerprint boot environments and their kernels, GRUB defaults, zedenv
+    properties, the generator itself, and pool layout and boot filesystems.
+    Raises RuntimeError if ZFS can't be queried.
+    """
+    pools = zedenv_grub.zfs.Pools()
+    datasets = [d for d in (be_root, root_dataset) if d]
+    if not properties or not set(datasets).issubset(properties.datasets):
+        properties = zedenv_grub.zfs.Properties(datasets)
+
+    fingerprint_input = {
+        "root": root_dataset,
+        "boot_environments": boot_environment_stamps(be_root, root_dataset, policy),
+        "boot_pool": boot_environment_stamps(boot_pool_root) if boot_pool_root else None,
+        "kernels": [zedenv_grub.mkconfig.dir_stats(d) for d in boot_dirs],
+        "defaults": zedenv_grub.mkconfig.path_stats(zedenv_grub.mkconfig.defaults_files()),
+        "generator": zedenv_grub.mkconfig.path_stats([zedenv_grub.mkconfig.GENERATOR]),
+        "properties": sorted(f"{d}\t{p}\t{v}" for (d, p), v in properties.values.items()),
+        "pools": {"guids": pools.guids, "bootfs": pools.bootfs, "topology": pools.topology}
+    }
+
+    return hashlib.sha256(
+        json.dumps(fingerprint_input, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,84 @@
+"""
+Boot environment entries kept in their own files, which the menu only reads when they are opened
+"""
+
+import os
+import tempfile
+
+import zedenv_grub.mkconfig
+
+from typing import List, Set
+
+FRAGMENT_DIR = "zedenv"
+
+
+def fragment_name(boot_environment: str) -> str:
+    return f"{boot_environment}.cfg"
+
+
+def source_line(boot_environment: str) -> str:
+    """
+    Read a fragment from next to the grub.cfg that references it
+    """
+    return f'source "${{config_directory}}/{FRAGMENT_DIR}/{fragment_name(boot_environment)}"'
+
+
+def write_fragment(path: str, fragment: str):
+    directory = os.path.dirname(path)
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}")
+    except OSError as e:
+        raise RuntimeError(f"Failed to write {path}.\n{e}")
+
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(fragment)
+
+        os.chmod(temp_path, 0o644)
+        zedenv_grub.mkconfig.check_syntax(temp_path)
+        os.replace(temp_path, path)
+    except (OSError, RuntimeError) as e:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise RuntimeError(f"Failed to write {path}.\n{e}")
+
+
+def update_fragment(directory: str, name: str, fragment: str) -> bool:
+    """
+    Write a fragment unless it is unchanged. Returns whether it was written.
+    """
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        raise RuntimeError(f"Failed to create {directory}.\n{e}")
+
+    path = os.path.join(directory, name)
+    try:
+        with open(path) as f:
+            if f.read() == fragment:
+                return False
+    except OSError:
+        pass
+
+    write_fragment(path, fragment)
+    return True
+
+
+def remove_stale(directory: str, names: Set[str]) -> List[str]:
+    """
+    Remove the fragments no longer referenced by the menu. Returns the names removed.
+    """
+    try:
+        stale = [n for n in os.listdir(directory) if n.endswith(".cfg") and n not in names]
+    except OSError:
+        stale = []
+
+    for name in stale:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError as e:
+            raise RuntimeError(f"Failed to remove {name} from {directory}.\n{e}")
+
+    return stale
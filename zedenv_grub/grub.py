@@ -1,18 +1,29 @@
+import filecmp
+import hashlib
 import shutil
 import os
 import tempfile
 import subprocess
 
-import pyzfscmds.utility
-import pyzfscmds.system.agnostic
+from concurrent.futures import ThreadPoolExecutor
 
 import zedenv.cli.mount
-import zedenv.lib.system
 import zedenv.lib.be
 import zedenv.plugins.configuration as plugin_config
 from zedenv.lib.logger import ZELogger
 
-from typing import Tuple
+import zedenv_grub.cache
+import zedenv_grub.fingerprint
+import zedenv_grub.inventory
+import zedenv_grub.menu
+import zedenv_grub.mkconfig
+import zedenv_grub.mountinfo
+import zedenv_grub.mounts
+import zedenv_grub.process
+import zedenv_grub.retention
+import zedenv_grub.zfs
+
+from typing import Callable, List, Optional, Tuple
 
 
 class GRUB(plugin_config.Plugin):
@@ -40,10 +51,120 @@ class GRUB(plugin_config.Plugin):
             "property": "simpleentries",
             "description": "Add simple entries in GRUB.",
             "default": "yes"
+        },
+        {
+            "property": "probecache",
+            "description": "Cache grub-probe results between runs.",
+            "default": "no"
+        },
+        {
+            "property": "nativeprobe",
+            "description": "Answer grub-probe queries for ZFS from pool metadata.",
+            "default": "no"
+        },
+        {
+            "property": "probetimeout",
+            "description": "Seconds a single grub-probe may take, 0 for no limit.",
+            "default": "30"
+        },
+        {
+            "property": "probebudget",
+            "description": "Seconds all probing in one run may take, 0 for no limit.",
+            "default": "120"
+        },
+        {
+            "property": "mkconfigtimeout",
+            "description": "Seconds grub-mkconfig may take, 0 for no limit.",
+            "default": "600"
+        },
+        {
+            "property": "kernelconfigcache",
+            "description": "Keep parsed kernel configs between runs.",
+            "default": "no"
+        },
+        {
+            "property": "kernelinventory",
+            "description": "Record kernels of boot environments to avoid mounting them.",
+            "default": "no"
+        },
+        {
+            "property": "mountconcurrency",
+            "description": "Number of boot environments mounted or unmounted at once.",
+            "default": "4"
+        },
+        {
+            "property": "umountretries",
+            "description": "Times to retry unmounting a busy boot environment.",
+            "default": "3"
+        },
+        {
+            "property": "lazyunmount",
+            "description": "Detach boot environments without waiting for them to be unused.",
+            "default": "no"
+        },
+        {
+            "property": "persistmounts",
+            "description": "Keep boot environments mounted between runs.",
+            "default": "no"
+        },
+        {
+            "property": "splice",
+            "description": "Only regenerate the zedenv section of grub.cfg when possible.",
+            "default": "no"
+        },
+        {
+            "property": "menuedits",
+            "description": "Edit the menu in place on destroy and rename when possible.",
+            "default": "yes"
+        },
+        {
+            "property": "fingerprint",
+            "description": "Skip regenerating the menu when none of its inputs changed.",
+            "default": "no"
+        },
+        {
+            "property": "activation",
+            "description": ("Select the default boot environment by regenerating the menu, "
+                            "'mkconfig', or with 'saved_entry' in grubenv, 'grubenv'."),
+            "default": "mkconfig"
+        },
+        {
+            "property": "layout",
+            "description": ("Keep every entry in grub.cfg, 'inline', or the entries of "
+                            "each boot environment in its own file, 'fragments'."),
+            "default": "inline"
+        },
+        {
+            "property": "sharedpreamble",
+            "description": "Access the boot device through one GRUB function shared by entries.",
+            "default": "no"
+        },
+        {
+            "property": "maxentries",
+            "description": "Number of newest boot environments in the menu, 0 for all.",
+            "default": "0"
+        },
+        {
+            "property": "kernelsperbe",
+            "description": "Number of newest kernels of each boot environment, 0 for all.",
+            "default": "0"
+        },
+        {
+            "property": "maxage",
+            "description": "Days after which boot environments leave the menu, 0 for never.",
+            "default": "0"
+        },
+        {
+            "property": "scanthreads",
+            "description": "Number of boot environment kernel directories scanned at once.",
+            "default": "4"
         }
     )
 
-    def __init__(self, zedenv_data: dict, skip_update: bool = False, skip_cleanup: bool = False):
+    def __init__(self, zedenv_data: dict, skip_update: bool = False, skip_cleanup: bool = False,
+                 properties: Optional[zedenv_grub.zfs.Properties] = None):
+
+        self.properties = properties
 
         super().__init__(zedenv_data)
 
@@ -121,6 +242,32 @@ class GRUB(plugin_config.Plugin):
             if not os.path.isdir(self.zedenv_properties["boot"]):
                 self.plugin_property_error("boot")
 
+        self.kernel_inventory = self.zedenv_properties["kernelinventory"] in ("yes", "1")
+        self.inventory_cache = None
+        if self.kernel_inventory:
+            self.inventory_cache = zedenv_grub.inventory.InventoryCache()
+        # Inventories of boot environments scanned while mounted, by dataset
+        self.scanned_inventories = {}
+
+        self.mount_state = None
+        if self.zedenv_properties["persistmounts"] in ("yes", "1"):
+            self.mount_state = zedenv_grub.mounts.MountState()
+        # Recorded as the holder of mounts kept between runs
+        self.operation = "activate"
+
+        if self.zedenv_properties["activation"] not in ("mkconfig", "grubenv"):
+            self.plugin_property_error("activation")
+        self.grubenv_activation = self.zedenv_properties["activation"] == "grubenv"
+
+        if self.zedenv_properties["layout"] not in ("inline", "fragments"):
+            self.plugin_property_error("layout")
+
+        try:
+            if int(self.zedenv_properties["scanthreads"]) < 1:
+                raise ValueError
+        except ValueError:
+            self.plugin_property_error("scanthreads")
+
         self.grub_boot_dir = os.path.join(
             self.boot_mountpoint, self.zedenv_properties["grubsubdir"])
 
@@ -134,7 +281,94 @@ class GRUB(plugin_config.Plugin):
 
         self.grub_cfg_path = os.path.join(self.grub_boot_dir, self.grub_cfg)
 
+    def check_zedenv_properties(self):
+        """
+        Read every plugin property from one property snapshot of the boot environment root
+        """
+        if not self.properties or self.be_root not in self.properties.datasets:
+            try:
+                self.properties = zedenv_grub.zfs.Properties([self.be_root])
+            except RuntimeError:
+                super().check_zedenv_properties()
+                return
+
+        for prop in self.zedenv_properties:
+            prop_val = self.properties.get(self.be_root, f"org.zedenv.{self.bootloader}:{prop}")
+            if prop_val and prop_val != "-":
+                self.zedenv_properties[prop] = prop_val
+
+    def splice_grub_config(self, location: str, state: zedenv_grub.cache.Cache,
+                           fingerprint: str) -> bool:
+        """
+        Regenerate only the zedenv section of an existing config. Returns False
+        if a full grub-mkconfig is needed because the inputs of the other
+        /etc/grub.d scripts changed since it last ran, or the section can't be replaced.
+        """
+        if state.data.get(location) != fingerprint:
+            ZELogger.verbose_log({
+                "level": "INFO",
+                "message": "GRUB inputs changed since the last full run.\n"
+            }, self.verbose)
+            return False
+
+        try:
+            with open(location) as f:
+                grub_cfg = f.read()
+        except OSError as e:
+            ZELogger.verbose_log({
+                "level": "INFO",
+                "message": f"Couldn't read {location}.\n{e}\n"
+            }, self.verbose)
+            return False
+
+        try:
+            section = zedenv_grub.mkconfig.generate_section()
+        except (SystemExit, Exception) as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"Failed to generate the zedenv section.\n{e}\n"
+            }, self.verbose)
+            return False
+
+        new_grub_cfg = zedenv_grub.mkconfig.splice(grub_cfg, section)
+        if new_grub_cfg is None:
+            ZELogger.verbose_log({
+                "level": "INFO",
+                "message": f"No single zedenv section in {location}.\n"
+            }, self.verbose)
+            return False
+
+        if new_grub_cfg == grub_cfg:
+            ZELogger.verbose_log({
+                "level": "INFO",
+                "message": f"GRUB config is unchanged, not rewriting {location}.\n"
+            }, self.verbose)
+            return True
+
+        try:
+            zedenv_grub.mkconfig.write_config(location, new_grub_cfg)
+        except RuntimeError as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"{e}\n"
+            }, self.verbose)
+            return False
+
+        ZELogger.verbose_log({
+            "level": "INFO",
+            "message": f"Replaced the zedenv section of {location}.\n"
+        }, self.verbose)
+        return True
+
     def grub_mkconfig(self, location: str):
+        splice = self.zedenv_properties["splice"] in ("yes", "1")
+        if splice:
+            state = zedenv_grub.cache.Cache("mkconfig")
+            fingerprint = zedenv_grub.mkconfig.inputs_fingerprint(
+                self.grub_boot_dir, self.grub_cfg)
+            if self.splice_grub_config(location, state, fingerprint):
+                return 0
+
         env = dict(os.environ, ZPOOL_VDEV_NAME_PATH='1')
         ZELogger.verbose_log({
             "level": "INFO",
@@ -142,16 +376,75 @@ class GRUB(plugin_config.Plugin):
                         "the GRUB configuration.\n")
         }, self.verbose)
 
-        grub_call = ["grub-mkconfig", "-o", location]
+        try:
+            timeout = float(self.zedenv_properties["mkconfigtimeout"]) or None
+        except ValueError:
+            self.plugin_property_error("mkconfigtimeout")
+
+        # Generate next to the old config so it is only replaced if it changed
+        try:
+            fd, temp_location = tempfile.mkstemp(
+                dir=os.path.dirname(location), prefix=f".{os.path.basename(location)}")
+            os.close(fd)
+        except OSError as e:
+            raise RuntimeError(f"Failed to generate GRUB config.\n{e}\n.")
+
+        grub_call = ["grub-mkconfig", "-o", temp_location]
 
         try:
-            grub_output = subprocess.check_call(grub_call, env=env,
-                                                universal_newlines=True, stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError as e:
+            grub_output = zedenv_grub.process.check_output(
+                grub_call, timeout, env=env, stderr=subprocess.PIPE)
+        except subprocess.TimeoutExpired as e:
+            self.remove_temp_config(temp_location)
+            raise RuntimeError(f"Timed out generating GRUB config.\n{e}\n.")
+        except (subprocess.CalledProcessError, OSError) as e:
+            self.remove_temp_config(temp_location)
             raise RuntimeError(f"Failed to generate GRUB config.\n{e}\n.")
 
+        try:
+            unchanged = filecmp.cmp(temp_location, location, shallow=False)
+        except OSError:
+            # No previous config to compare with
+            unchanged = False
+
+        try:
+            if unchanged:
+                ZELogger.verbose_log({
+                    "level": "INFO",
+                    "message": f"GRUB config is unchanged, not rewriting {location}.\n"
+                }, self.verbose)
+                os.remove(temp_location)
+            else:
+                # The temporary file is created private, keep the old config's permissions
+                if os.path.exists(location):
+                    shutil.copymode(location, temp_location)
+                os.replace(temp_location, location)
+        except OSError as e:
+            self.remove_temp_config(temp_location)
+            raise RuntimeError(f"Failed to write GRUB config.\n{e}\n.")
+
+        if splice:
+            state.data[location] = zedenv_grub.mkconfig.inputs_fingerprint(
+                self.grub_boot_dir, self.grub_cfg)
+            state.dirty = True
+            try:
+                state.save()
+            except RuntimeError as e:
+                ZELogger.verbose_log({
+                    "level": "WARNING",
+                    "message": f"Couldn't record GRUB inputs.\n{e}\n"
+                }, self.verbose)
+
         return grub_output
 
+    @staticmethod
+    def remove_temp_config(temp_location: str):
+        for p in (temp_location, f"{temp_location}.new"):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
     def modify_bootloader(self, temp_boot: str):
 
         real_kernel_dir = os.path.join(self.zedenv_properties["boot"], "env")
@@ -196,66 +489,316 @@ class GRUB(plugin_config.Plugin):
                         "message": f"IOError writing to {temp_new_dataset_kernel}\n{e}"
                     }, exit_on_error=True)
 
+    @staticmethod
+    def get_root_dataset() -> Optional[str]:
+        root_mount = zedenv_grub.mountinfo.MountInfo().find_mount("/")
+        return root_mount[3] if root_mount and root_mount[2] == "zfs" else None
+
+    def list_boot_environments(self) -> zedenv_grub.zfs.BootEnvironments:
+        """
+        List boot environments and their mountpoints with a single 'zfs list'
+        """
+        try:
+            return zedenv_grub.zfs.BootEnvironments(
+                self.be_root, root_dataset=self.get_root_dataset())
+        except RuntimeError as e:
+            ZELogger.log({
+                "level": "EXCEPTION",
+                "message": f"Failed to list boot environments.\n{e}\n"
+            }, exit_on_error=True)
+
     def setup_boot_env_tree(self):
         mount_root = os.path.join(self.zedenv_properties["boot"], self.zfs_env_dir)
 
         if not os.path.exists(mount_root):
             os.mkdir(mount_root)
 
-        be_list = zedenv.lib.be.list_boot_environments(self.be_root, ['name'])
-        ZELogger.verbose_log(
-            {"level": "INFO", "message": f"Going over list {be_list}.\n"}, self.verbose)
-
-        for b in be_list:
-            if not pyzfscmds.utility.is_snapshot(b['name']):
-                be_name = pyzfscmds.utility.dataset_child_name(b['name'], False)
-
-                if not zedenv.lib.be.extra_bpool():
-                    # Check if 'b' is current dataset
-                    if pyzfscmds.system.agnostic.dataset_mountpoint(b['name']) == "/":
-                        ZELogger.verbose_log({
-                            "level": "INFO",
-                            "message": f"Dataset {b['name']} is root, skipping.\n"
-                        }, self.verbose)
-                    else:
-                        be_boot_mount = os.path.join(mount_root, f"zedenv-{be_name}")
-                        ZELogger.verbose_log({
-                            "level": "INFO",
-                            "message": f"Setting up {b['name']}.\n"
-                        }, self.verbose)
-
-                        if not os.path.exists(be_boot_mount):
-                            os.mkdir(be_boot_mount)
-
-                        if not os.listdir(be_boot_mount):
-                            zedenv.cli.mount.zedenv_mount(be_name,
-                                                          be_boot_mount,
-                                                          self.verbose, self.be_root)
-                        else:
-                            ZELogger.verbose_log({
-                                "level": "WARNING",
-                                "message": (f"Mount directory {be_boot_mount}"
-                                            " wasn't empty, skipping.\n")
-                            }, self.verbose)
-                else:
-                    # Mount all boot datasets
-                    be_boot = zedenv.lib.be.root("/boot")
+        boot_environments = self.list_boot_environments()
+        ZELogger.verbose_log({
+            "level": "INFO",
+            "message": f"Going over list {list(boot_environments.table)}.\n"
+        }, self.verbose)
+
+        extra_bpool = zedenv.lib.be.extra_bpool()
+        if extra_bpool:
+            be_boot = zedenv.lib.be.root("/boot")
+
+        if self.mount_state:
+            self.release_stale_mounts(mount_root, boot_environments, extra_bpool)
+
+        # Boot environments left out of the menu don't need to be mounted
+        retained = self.retention_policy().retained(boot_environments)
+
+        # (dataset, boot environment, mount directory, be root, extra arguments)
+        mounts = []
+        # (mount directory, dataset) of mounts kept from an earlier run
+        reused = []
+        inventory_dirs = []
+        for be_name, b in boot_environments.table.items():
+            if retained is not None and be_name not in retained:
+                ZELogger.verbose_log({
+                    "level": "INFO",
+                    "message": f"Dataset {b['name']} is left out of the menu, skipping.\n"
+                }, self.verbose)
+                continue
+
+            if not extra_bpool:
+                # Check if 'b' is current dataset
+                if boot_environments.is_root(b):
+                    ZELogger.verbose_log({
+                        "level": "INFO",
+                        "message": f"Dataset {b['name']} is root, skipping.\n"
+                    }, self.verbose)
+                    continue
+                elif self.kernel_inventory and zedenv_grub.inventory.fresh(
+                        b, self.inventory_cache):
+                    ZELogger.verbose_log({
+                        "level": "INFO",
+                        "message": f"Kernel inventory of {b['name']} is current, skipping.\n"
+                    }, self.verbose)
+                    continue
+
+            be_boot_mount = os.path.join(mount_root, f"zedenv-{be_name}")
+            if not extra_bpool:
+                mount = (b["name"], be_name, be_boot_mount, self.be_root, {})
+            else:
+                # Mount all boot datasets
+                mount = (b["name"], f"zedenv-{be_name}", be_boot_mount,
+                         be_boot, {"check_bpool": False})
+
+            ZELogger.verbose_log({
+                "level": "INFO",
+                "message": f"Setting up {b['name']}.\n"
+            }, self.verbose)
+
+            if not os.path.exists(be_boot_mount):
+                os.mkdir(be_boot_mount)
+
+            if not os.listdir(be_boot_mount):
+                mounts.append(mount)
+            elif self.mount_state and self.mount_state.holds(be_boot_mount, b["name"]):
+                ZELogger.verbose_log({
+                    "level": "INFO",
+                    "message": f"{b['name']} is still mounted on {be_boot_mount}, reusing it.\n"
+                }, self.verbose)
+                reused.append((be_boot_mount, b["name"]))
+            else:
+                ZELogger.verbose_log({
+                    "level": "WARNING",
+                    "message": f"Mount directory {be_boot_mount} wasn't empty, skipping.\n"
+                }, self.verbose)
+
+            if self.kernel_inventory and not extra_bpool:
+                inventory_dirs.append((b, os.path.join(be_boot_mount, "boot")))
+
+        failed = self.mount_boot_environments(mounts)
+
+        for b, boot_dir in inventory_dirs:
+            if b["name"] not in failed:
+                self.scan_inventory(b, boot_dir)
+
+        if self.mount_state:
+            mounted = [(m[2], m[0]) for m in mounts if m[0] not in failed]
+            for be_boot_mount, dataset in reused + mounted:
+                self.mount_state.hold(be_boot_mount, dataset, self.operation)
+            self.save_mount_state()
+
+            if mounted:
+                ZELogger.log({
+                    "level": "WARNING",
+                    "message": (f"Keeping {', '.join(d for _, d in mounted)} mounted until "
+                                "destroyed, renamed or 'zedenv-grub mounts cleanup'. "
+                                "Run the cleanup first if destroying one reports it busy.\n")
+                })
+
+    def release_stale_mounts(self, mount_root: str,
+                             boot_environments: zedenv_grub.zfs.BootEnvironments,
+                             extra_bpool: bool):
+        """
+        Unmount mounts kept from earlier runs whose boot environment
+        was destroyed, renamed or has become root
+        """
+        self.mount_state.prune()
+
+        stale = []
+        for mount_path, mount in self.mount_state.mounts.items():
+            if os.path.dirname(mount_path) != mount_root:
+                continue
+
+            b = boot_environments.table.get(
+                os.path.basename(mount_path)[len(f"{self.entry_prefix}-"):])
+            if not b or b["name"] != mount["dataset"] or (
+                    not extra_bpool and boot_environments.is_root(b)):
+                stale.append(mount_path)
+
+        self.release_mounts(stale)
+
+    def release_boot_environment_mounts(self, boot_environment: str):
+        """
+        Unmount the mount kept from an earlier run of a boot environment
+        that was destroyed or renamed
+        """
+        if not self.mount_state:
+            return
+
+        # A destroyed boot environment was already unmounted by ZFS
+        self.mount_state.prune()
+
+        mount_name = f"{self.entry_prefix}-{boot_environment}"
+        self.release_mounts(
+            [m for m in self.mount_state.mounts if os.path.basename(m) == mount_name])
+
+    def release_mounts(self, mount_paths: List[str]):
+        """
+        Unmount mounts kept between runs, and forget and remove the ones unmounted
+        """
+        errors = self.unmount_boot_environments(mount_paths) if mount_paths else {}
+        for mount_path in mount_paths:
+            if mount_path in errors:
+                continue
+
+            self.mount_state.release(mount_path)
+            try:
+                os.rmdir(mount_path)
+            except OSError as ex:
+                ZELogger.verbose_log({
+                    "level": "WARNING",
+                    "message": f"Couldn't remove directory {mount_path}.\n{ex}\n"
+                }, self.verbose)
+
+        self.save_mount_state()
+
+    def save_mount_state(self):
+        try:
+            self.mount_state.save()
+        except RuntimeError as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"Couldn't record mounts kept between runs.\n{e}\n"
+            }, self.verbose)
+
+    def retention_policy(self) -> zedenv_grub.retention.Policy:
+        try:
+            max_count = int(self.zedenv_properties["maxentries"])
+            if max_count < 0:
+                raise ValueError
+        except ValueError:
+            self.plugin_property_error("maxentries")
+
+        try:
+            max_age = float(self.zedenv_properties["maxage"])
+            if max_age < 0:
+                raise ValueError
+        except ValueError:
+            self.plugin_property_error("maxage")
+
+        keep = ()
+        if max_count or max_age:
+            keep = tuple(d for d in (self.default_dataset(),) if d)
+
+        return zedenv_grub.retention.Policy(max_count, max_age, keep)
+
+    def mount_concurrency(self) -> int:
+        try:
+            concurrency = int(self.zedenv_properties["mountconcurrency"])
+            if concurrency < 1:
+                raise ValueError
+        except ValueError:
+            self.plugin_property_error("mountconcurrency")
+
+        return concurrency
+
+    def mount_boot_environments(self, mounts: List[tuple]) -> List[str]:
+        """
+        Mount boot environments on a bounded number of workers. A failed mount
+        doesn't stop the others, its mount directory is removed so the generator
+        doesn't look for kernels in it. Returns the datasets that failed to mount.
+        """
+        def mount(job: tuple) -> Optional[BaseException]:
+            _, be_name, be_boot_mount, be_root, kwargs = job
+            try:
+                zedenv.cli.mount.zedenv_mount(
+                    be_name, be_boot_mount, self.verbose, be_root, **kwargs)
+            except (SystemExit, Exception) as e:
+                return e
+
+            return None
 
-                    be_boot_mount = os.path.join(mount_root, f"zedenv-{be_name}")
-                    ZELogger.verbose_log(
-                        {"level": "INFO", "message": f"Setting up {b['name']}.\n"}, self.verbose)
+        with ThreadPoolExecutor(max_workers=self.mount_concurrency()) as executor:
+            results = list(executor.map(mount, mounts))
 
-                    if not os.path.exists(be_boot_mount):
-                        os.mkdir(be_boot_mount)
+        failed = []
+        for job, error in zip(mounts, results):
+            if error is not None:
+                failed.append(job[0])
+                ZELogger.log({
+                    "level": "WARNING",
+                    "message": (f"Failed to mount {job[0]} on {job[2]}, "
+                                f"its kernels won't be in the GRUB menu.\n{error}\n")
+                })
+                try:
+                    os.rmdir(job[2])
+                except OSError as e:
+                    ZELogger.verbose_log({
+                        "level": "WARNING",
+                        "message": f"Couldn't remove directory {job[2]}.\n{e}\n"
+                    }, self.verbose)
 
-                    if not os.listdir(be_boot_mount):
-                        zedenv.cli.mount.zedenv_mount(f"zedenv-{be_name}", be_boot_mount,
-                                                      self.verbose, be_boot, check_bpool=False)
-                    else:
-                        ZELogger.verbose_log({
-                            "level": "WARNING",
-                            "message": f"Mount directory {be_boot_mount} wasn't empty, skipping.\n"
-                        }, self.verbose)
+        ZELogger.verbose_log({
+            "level": "INFO",
+            "message": (f"Mounted {len(mounts) - len(failed)} of {len(mounts)} "
+                        f"boot environments, failed: {failed or 'none'}.\n")
+        }, self.verbose)
+
+        return failed
+
+    def scan_inventory(self, be: dict, boot_dir: str):
+        try:
+            self.scanned_inventories[be["name"]] = zedenv_grub.inventory.scan(boot_dir)
+        except OSError as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"Couldn't take kernel inventory of {be['name']}.\n{e}\n"
+            }, self.verbose)
+
+    def write_inventories(self):
+        """
+        Store inventories of the boot environments scanned during setup. Done after
+        unmounting so the stamp includes any changes made while they were mounted.
+        """
+        boot_environments = {
+            b["name"]: b for b in self.list_boot_environments().table.values()}
+
+        for dataset, inventory in self.scanned_inventories.items():
+            if dataset not in boot_environments:
+                continue
+
+            self.inventory_cache.set(boot_environments[dataset], inventory)
+
+            try:
+                written = zedenv_grub.inventory.write(boot_environments[dataset], inventory)
+            except RuntimeError as e:
+                ZELogger.verbose_log({
+                    "level": "WARNING",
+                    "message": f"Couldn't store kernel inventory of {dataset}.\n{e}\n"
+                }, self.verbose)
+            else:
+                if written:
+                    ZELogger.verbose_log({
+                        "level": "INFO",
+                        "message": f"Stored kernel inventory of {dataset}.\n"
+                    }, self.verbose)
+
+        self.scanned_inventories = {}
+
+        self.inventory_cache.prune(list(boot_environments))
+        try:
+            self.inventory_cache.save()
+        except RuntimeError as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"Couldn't save kernel inventories.\n{e}\n"
+            }, self.verbose)
 
     def teardown_boot_env_tree(self):
         def ismount(path, boot):
@@ -282,39 +825,49 @@ class GRUB(plugin_config.Plugin):
                 "message": f"Mount root: '{mount_root}' doesnt exist.\n"
             }, self.verbose)
         else:
-            for m in os.listdir(mount_root):
-                mount_path = os.path.join(mount_root, m)
-                ZELogger.verbose_log({
-                    "level": "INFO",
-                    "message": f"Unmounting {m}\n"
-                }, self.verbose)
-                if ismount(mount_path, self.boot_mountpoint):
-                    try:
-                        zedenv.lib.system.umount(mount_path)
-                    except RuntimeError as e:
-                        ZELogger.log({
-                            "level": "WARNING",
-                            "message": f"Failed Un-mountingdataset from '{m}'.\n{e}"
-                        }, exit_on_error=True)
-                        cleanup = False
-                    else:
-                        ZELogger.verbose_log({
-                            "level": "INFO",
-                            "message": f"Unmounted {m} from {mount_path}.\n"
-                        }, self.verbose)
-                        try:
-                            os.rmdir(mount_path)
-                        except OSError as ex:
-                            ZELogger.verbose_log({
-                                "level": "WARNING",
-                                "message": f"Couldn't remove directory {mount_path}.\n{ex}\n"
-                            }, self.verbose)
-                            cleanup = False
-                        else:
-                            ZELogger.verbose_log({
-                                "level": "INFO",
-                                "message": f"Removed directory {mount_path}.\n"
-                            }, self.verbose)
+            mount_dirs = [os.path.join(mount_root, m) for m in os.listdir(mount_root)]
+            if self.mount_state:
+                # Mounts kept between runs are only released by destroy, rename or cleanup
+                held = [m for m in mount_dirs if m in self.mount_state.mounts]
+                if held:
+                    ZELogger.verbose_log({
+                        "level": "INFO",
+                        "message": f"Keeping {len(held)} boot environments mounted.\n"
+                    }, self.verbose)
+                    mount_dirs = [m for m in mount_dirs if m not in held]
+                    cleanup = False
+
+            mounted = [m for m in mount_dirs if ismount(m, self.boot_mountpoint)]
+
+            errors = self.unmount_boot_environments(mounted)
+
+            leftover = []
+            for mount_path in mount_dirs:
+                if mount_path in errors:
+                    leftover.append(mount_path)
+                    cleanup = False
+                    continue
+
+                try:
+                    os.rmdir(mount_path)
+                except OSError as ex:
+                    ZELogger.verbose_log({
+                        "level": "WARNING",
+                        "message": f"Couldn't remove directory {mount_path}.\n{ex}\n"
+                    }, self.verbose)
+                    cleanup = False
+                else:
+                    ZELogger.verbose_log({
+                        "level": "INFO",
+                        "message": f"Removed directory {mount_path}.\n"
+                    }, self.verbose)
+
+            if leftover:
+                ZELogger.log({
+                    "level": "WARNING",
+                    "message": ("Boot environments are still mounted on "
+                                f"{', '.join(leftover)}, unmount them manually.\n")
+                })
 
         if cleanup and os.path.exists(mount_root):
             try:
@@ -325,6 +878,252 @@ class GRUB(plugin_config.Plugin):
                     "message": f"Couldn't remove directory {mount_root}.\n{ex}\n"
                 }, self.verbose)
 
+        if self.scanned_inventories:
+            self.write_inventories()
+
+    def unmount(self, mount_path: str, retries: int, lazy: bool) -> Optional[str]:
+        """
+        Unmount a boot environment with zedenv_grub.mounts.unmount, logging retries.
+        Returns the error if it couldn't be unmounted.
+        """
+        def log_retry(error: str, delay: float):
+            ZELogger.verbose_log({
+                "level": "INFO",
+                "message": f"Couldn't unmount {mount_path}, retrying in {delay}s.\n{error}\n"
+            }, self.verbose)
+
+        error = zedenv_grub.mounts.unmount(mount_path, retries, lazy, on_retry=log_retry)
+        if error is None:
+            ZELogger.verbose_log({
+                "level": "INFO",
+                "message": f"Unmounted {mount_path}.\n"
+            }, self.verbose)
+
+        return error
+
+    def unmount_boot_environments(self, mount_paths: List[str]) -> dict:
+        """
+        Unmount boot environments on a bounded number of workers.
+        Returns the errors of the ones left mounted, by mount path.
+        """
+        try:
+            retries = int(self.zedenv_properties["umountretries"])
+            if retries < 0:
+                raise ValueError
+        except ValueError:
+            self.plugin_property_error("umountretries")
+
+        lazy = self.zedenv_properties["lazyunmount"] in ("yes", "1")
+
+        with ThreadPoolExecutor(max_workers=self.mount_concurrency()) as executor:
+            results = list(executor.map(
+                lambda m: self.unmount(m, retries, lazy), mount_paths))
+
+        errors = {m: e for m, e in zip(mount_paths, results) if e is not None}
+        for mount_path, error in errors.items():
+            ZELogger.log({
+                "level": "WARNING",
+                "message": f"{error}\n"
+            })
+
+        ZELogger.verbose_log({
+            "level": "INFO",
+            "message": (f"Unmounted {len(mount_paths) - len(errors)} of {len(mount_paths)} "
+                        "boot environments.\n")
+        }, self.verbose)
+
+        return errors
+
+    def entries_fingerprint(self) -> Optional[str]:
+        """
+        Fingerprint every input of the boot environment entries, or None if it can't be taken
+        """
+        boot_pool_root = zedenv.lib.be.root("/boot") if zedenv.lib.be.extra_bpool() else None
+        kernel_dirs = zedenv_grub.fingerprint.kernel_dirs(
+            self.zedenv_properties["boot"], self.bootonzfs)
+
+        try:
+            return zedenv_grub.fingerprint.menu_fingerprint(
+                self.be_root, self.get_root_dataset(), kernel_dirs, self.properties,
+                boot_pool_root, self.retention_policy())
+        except RuntimeError as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"Couldn't fingerprint the GRUB menu inputs.\n{e}\n"
+            }, self.verbose)
+            return None
+
+    def entry_stamps(self) -> Optional[dict]:
+        """
+        Fingerprint the inputs of each boot environment's entries, or None if it can't be taken
+        """
+        boot_pool_root = zedenv.lib.be.root("/boot") if zedenv.lib.be.extra_bpool() else None
+
+        try:
+            return zedenv_grub.fingerprint.entry_stamps(
+                self.be_root, self.get_root_dataset(), self.zedenv_properties["boot"],
+                self.bootonzfs, boot_pool_root)
+        except RuntimeError as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"Couldn't fingerprint the boot environment entries.\n{e}\n"
+            }, self.verbose)
+            return None
+
+    def entries_state(self) -> zedenv_grub.cache.Cache:
+        """
+        Get the cache recording what each boot environment's entries were generated from
+        """
+        return zedenv_grub.cache.Cache("grubenv")
+
+    def entries_current(self, dataset: str) -> bool:
+        """
+        Check the menu's entries for a boot environment were generated from its current
+        kernels, recorded when the menu was last generated with activation=grubenv
+        """
+        generated = self.entries_state().data.get(self.grub_cfg_path)
+        if not isinstance(generated, dict) or not isinstance(generated.get("entries"), dict):
+            return False
+
+        recorded = generated["entries"].get(dataset)
+        if not recorded:
+            return False
+
+        stamps = self.entry_stamps()
+        return bool(stamps) and stamps.get(dataset) == recorded
+
+    def record_entries(self):
+        stamps = self.entry_stamps()
+        if stamps is None:
+            return
+
+        state = self.entries_state()
+        state.data[self.grub_cfg_path] = {"entries": stamps}
+        state.dirty = True
+
+        try:
+            state.save()
+        except RuntimeError as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"Couldn't record the boot environment entries.\n{e}\n"
+            }, self.verbose)
+
+    def menu_fingerprint(self) -> Optional[str]:
+        """
+        Fingerprint every input of the GRUB config, the entries and what the other
+        /etc/grub.d scripts read, or None if it can't be taken
+        """
+        entries = self.entries_fingerprint()
+        if not entries:
+            return None
+
+        other_scripts = zedenv_grub.mkconfig.inputs_fingerprint(self.grub_boot_dir, self.grub_cfg)
+        return f"{entries}:{other_scripts}"
+
+    @staticmethod
+    def config_hash(location: str) -> Optional[str]:
+        try:
+            with open(location, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def menu_current(self, menu_state: zedenv_grub.cache.Cache) -> bool:
+        """
+        Check the GRUB config was generated from the current inputs and hasn't changed since
+        """
+        generated = menu_state.data.get(self.grub_cfg_path)
+        if not isinstance(generated, dict):
+            return False
+
+        return generated.get("config") == self.config_hash(self.grub_cfg_path) and \
+            generated.get("fingerprint") == self.menu_fingerprint()
+
+    def record_menu(self, menu_state: zedenv_grub.cache.Cache):
+        fingerprint = self.menu_fingerprint()
+        if not fingerprint:
+            return
+
+        menu_state.data[self.grub_cfg_path] = {
+            "fingerprint": fingerprint,
+            "config": self.config_hash(self.grub_cfg_path)
+        }
+        menu_state.dirty = True
+
+        try:
+            menu_state.save()
+        except RuntimeError as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"Couldn't record the GRUB menu inputs.\n{e}\n"
+            }, self.verbose)
+
+    def fingerprint_state(self, name: str = "menu") -> Optional[zedenv_grub.cache.Cache]:
+        """
+        Get the cache recording what was generated from which inputs, if enabled
+        """
+        if self.zedenv_properties["fingerprint"] not in ("yes", "1"):
+            return None
+
+        return zedenv_grub.cache.Cache(name)
+
+    def default_dataset(self) -> Optional[str]:
+        """
+        Get the boot environment the menu should boot by default, the one being
+        activated or, for other operations, the boot filesystem of its pool
+        """
+        if self.operation == "activate":
+            return os.path.join(self.be_root, self.boot_environment)
+
+        try:
+            return zedenv.lib.be.bootfs_for_pool(self.be_root.split("/")[0])
+        except RuntimeError as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"Couldn't get the boot filesystem.\n{e}\n"
+            }, self.verbose)
+            return None
+
+    def menu_boots(self, dataset: str) -> bool:
+        """
+        Check grub.cfg selects its default from grubenv and can boot a boot environment by it
+        """
+        try:
+            with open(self.grub_cfg_path) as f:
+                section = zedenv_grub.mkconfig.section(f.read())
+        except OSError:
+            return False
+
+        return bool(section) and zedenv_grub.menu.has_grubenv_default(
+            section.splitlines(), dataset)
+
+    def select_default_entry(self) -> bool:
+        """
+        Point 'saved_entry' in grubenv at the boot environment to boot by default
+        """
+        dataset = self.default_dataset()
+        if not dataset:
+            return False
+
+        grubenv = os.path.join(self.grub_boot_dir, "grubenv")
+        entry_id = zedenv_grub.menu.default_entry_id(dataset)
+        try:
+            subprocess.check_call(["grub-editenv", grubenv, "set", f"saved_entry={entry_id}"],
+                                  universal_newlines=True, stderr=subprocess.PIPE)
+        except (subprocess.CalledProcessError, OSError) as e:
+            ZELogger.log({
+                "level": "WARNING",
+                "message": f"Failed to set the default GRUB entry in {grubenv}.\n{e}\n"
+            })
+            return False
+
+        ZELogger.verbose_log({
+            "level": "INFO",
+            "message": f"Set the default GRUB entry to {entry_id}.\n"
+        }, self.verbose)
+        return True
+
     def post_activate(self):
         ZELogger.verbose_log({
             "level": "INFO",
@@ -343,9 +1142,30 @@ class GRUB(plugin_config.Plugin):
                 self.modify_bootloader(t_grub)
                 self.recurse_move(t_grub, self.zedenv_properties["boot"], overwrite=False)
 
+        select_default = self.grubenv_activation and not self.skip_update_grub
+
+        # The menu already has an entry for every boot environment, only the default changes,
+        # unless the entries of the one being activated were generated from older kernels
+        if select_default and self.operation == "activate":
+            dataset = self.default_dataset()
+            if self.menu_boots(dataset) and self.entries_current(dataset) and \
+                    self.select_default_entry():
+                return
+
+        menu_state = None if self.skip_update_grub else self.fingerprint_state()
+        if menu_state and self.menu_current(menu_state):
+            ZELogger.verbose_log({
+                "level": "INFO",
+                "message": f"GRUB menu at {self.grub_cfg_path} is current, skipping.\n"
+            }, self.verbose)
+            if select_default:
+                self.select_default_entry()
+            return
+
         if self.bootonzfs:
             self.setup_boot_env_tree()
 
+        generated = False
         if not self.skip_update_grub:
             try:
                 self.grub_mkconfig(self.grub_cfg_path)
@@ -355,6 +1175,7 @@ class GRUB(plugin_config.Plugin):
                     "message": f"During 'post activate', 'grub-mkconfig' failed with:\n{e}.\n"
                 }, self.verbose)
             else:
+                generated = True
                 ZELogger.verbose_log({
                     "level": "INFO",
                     "message": f"Generated GRUB menu successfully at {self.grub_cfg_path}.\n"
@@ -363,6 +1184,14 @@ class GRUB(plugin_config.Plugin):
         if self.bootonzfs and not self.skip_cleanup:
             self.teardown_boot_env_tree()
 
+        if select_default and generated:
+            self.select_default_entry()
+            self.record_entries()
+
+        # Taken after teardown, which may have changed the boot environments it mounted
+        if menu_state and generated:
+            self.record_menu(menu_state)
+
     def pre_activate(self):
         pass
 
@@ -378,11 +1207,89 @@ class GRUB(plugin_config.Plugin):
         if not self.bootonzfs:
             self.modify_fstab(be_mountpoint, replace_pattern, self.new_entry)
 
+    def edit_grub_menu(self, edit: Callable[[str], Optional[str]]) -> bool:
+        """
+        Apply a targeted edit to the zedenv section of the current grub.cfg.
+        Returns False if the edit can't be applied unambiguously and the menu has to be rebuilt.
+        """
+        if self.skip_update_grub or self.zedenv_properties["menuedits"] not in ("yes", "1"):
+            return False
+
+        # Kernels on a separate boot pool aren't named after the boot environment dataset
+        if not self.bootonzfs or zedenv.lib.be.extra_bpool():
+            return False
+
+        # Fragments are named after the boot environment and hold its entries
+        if self.zedenv_properties["layout"] == "fragments":
+            return False
+
+        # Removing a boot environment can bring back one the retention limits left out
+        policy = self.retention_policy()
+        if policy.max_count or policy.max_age:
+            return False
+
+        try:
+            with open(self.grub_cfg_path) as f:
+                grub_cfg = f.read()
+        except OSError:
+            return False
+
+        section = zedenv_grub.mkconfig.section(grub_cfg)
+        new_section = edit(section) if section else None
+        if new_section is None:
+            ZELogger.verbose_log({
+                "level": "INFO",
+                "message": "Couldn't edit the GRUB menu in place, regenerating it.\n"
+            }, self.verbose)
+            return False
+
+        try:
+            zedenv_grub.mkconfig.write_config(
+                self.grub_cfg_path, zedenv_grub.mkconfig.splice(grub_cfg, new_section))
+        except RuntimeError as e:
+            ZELogger.verbose_log({
+                "level": "WARNING",
+                "message": f"{e}\n"
+            }, self.verbose)
+            return False
+
+        ZELogger.verbose_log({
+            "level": "INFO",
+            "message": f"Edited the GRUB menu at {self.grub_cfg_path}.\n"
+        }, self.verbose)
+
+        # A renamed boot environment may have been the default
+        if self.grubenv_activation:
+            self.select_default_entry()
+
+        menu_state = self.fingerprint_state()
+        if menu_state:
+            self.record_menu(menu_state)
+
+        return True
+
     def post_destroy(self, target):
+        self.operation = "destroy"
+        self.release_boot_environment_mounts(target)
+
+        dataset = os.path.join(self.be_root, target)
+        if self.edit_grub_menu(lambda s: zedenv_grub.menu.remove_entries(s, dataset)):
+            return
+
         self.post_activate()
 
     def post_create(self):
+        self.operation = "create"
         self.post_activate()
 
     def post_rename(self):
+        self.operation = "rename"
+        self.release_boot_environment_mounts(self.old_boot_environment)
+
+        old_dataset = os.path.join(self.be_root, self.old_boot_environment)
+        new_dataset = os.path.join(self.be_root, self.boot_environment)
+        if old_dataset != new_dataset and self.edit_grub_menu(
+                lambda s: zedenv_grub.menu.rename_entries(s, old_dataset, new_dataset)):
+            return
+
         self.post_activate()
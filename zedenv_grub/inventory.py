@@ -0,0 +1,137 @@
+"""
+Kernel inventories of boot environments, kept in a ZFS user property
+so boot environments can be added to the menu without mounting them
+"""
+
+import json
+import os
+
+import zedenv_grub.cache
+import zedenv_grub.kernel_config
+import zedenv_grub.zfs
+
+from typing import List, Optional
+
+PROPERTY = zedenv_grub.zfs.BootEnvironments.inventory_property
+
+# Kernel config settings the generator reads
+CONFIG_KEYS = ("CONFIG_INITRAMFS_SOURCE", "CONFIG_FB_EFI", "CONFIG_VT_HW_CONSOLE_BINDING")
+
+# Longest value ZFS allows for a user property
+MAX_LENGTH = 8192
+
+
+def stamp(be: dict) -> str:
+    """
+    Changes whenever the boot environment dataset is replaced or written to.
+    The latest snapshot catches writes hidden by a snapshot resetting 'written'.
+    """
+    return ":".join(
+        be[c] for c in ("guid", "createtxg", "written", "referenced", "snapshottxg"))
+
+
+def scan(boot_dir: str) -> dict:
+    """
+    Record size and mtime of every regular file in a boot directory, and
+    the settings the generator needs from each kernel config
+    """
+    inventory = {"files": {}, "configs": {}}
+
+    with os.scandir(boot_dir) as boot_dir_entries:
+        for e in boot_dir_entries:
+            if not e.is_file():
+                continue
+
+            st = e.stat()
+            inventory["files"][e.name] = [st.st_size, int(st.st_mtime)]
+
+            if e.name.startswith("config-"):
+                try:
+                    with open(e.path, errors="replace") as f:
+                        config = zedenv_grub.kernel_config.parse_config(f.read())
+                except OSError:
+                    continue
+                inventory["configs"][e.name] = {
+                    k: config[k] for k in CONFIG_KEYS if k in config}
+
+    return inventory
+
+
+def encode(inventory: dict) -> Optional[str]:
+    value = json.dumps(inventory, separators=(",", ":"), sort_keys=True)
+    return value if len(value) <= MAX_LENGTH else None
+
+
+def decode(value: str) -> Optional[dict]:
+    if not value or value == "-":
+        return None
+
+    try:
+        inventory = json.loads(value)
+    except ValueError:
+        return None
+
+    if not isinstance(inventory, dict) or not all(
+            isinstance(inventory.get(k), dict) for k in ("files", "configs")):
+        return None
+
+    return inventory
+
+
+def fresh(be: dict, store: Optional["InventoryCache"] = None) -> Optional[dict]:
+    """
+    Get a boot environment's inventory if it was taken since the dataset last changed,
+    from its property or else from the local store
+    """
+    inventory = decode(be.get(PROPERTY))
+    if inventory and inventory.get("stamp") == stamp(be):
+        return inventory
+
+    return store.get(be) if store else None
+
+
+def write(be: dict, inventory: dict) -> bool:
+    """
+    Store an inventory stamped with the dataset's current state,
+    returns False if it did not need to change or is too long to store
+    """
+    value = encode(dict(inventory, stamp=stamp(be)))
+    if not value or value == be.get(PROPERTY):
+        return False
+
+    zedenv_grub.zfs.zfs_command("zfs", ["set", f"{PROPERTY}={value}", be["name"]])
+    return True
+
+
+class InventoryCache(zedenv_grub.cache.Cache):
+    """
+    Local copy of every inventory taken, by dataset. Also covers boot environments
+    whose inventory is too long for a property or couldn't be stored there.
+    """
+
+    def __init__(self, cache_dir: str = zedenv_grub.cache.CACHE_DIR):
+        super().__init__("inventory", cache_dir)
+
+        if not isinstance(self.data.get("inventories"), dict):
+            self.data["inventories"] = {}
+
+    def get(self, be: dict) -> Optional[dict]:
+        inventory = self.data["inventories"].get(be["name"])
+        if isinstance(inventory, dict) and inventory.get("stamp") == stamp(be):
+            return inventory
+
+        return None
+
+    def set(self, be: dict, inventory: dict):
+        inventory = dict(inventory, stamp=stamp(be))
+        if self.data["inventories"].get(be["name"]) != inventory:
+            self.data["inventories"][be["name"]] = inventory
+            self.dirty = True
+
+    def prune(self, datasets: List[str]):
+        """
+        Drop inventories of datasets that no longer exist
+        """
+        for dataset in [d for d in self.data["inventories"] if d not in datasets]:
+            del self.data["inventories"][dataset]
+            self.dirty = True
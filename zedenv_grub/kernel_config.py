@@ -0,0 +1,91 @@
+"""
+Parsed kernel configs shared by every entry in a run
+"""
+
+import hashlib
+import os
+
+import zedenv_grub.cache
+
+from typing import Optional
+
+
+def parse_config(content: str) -> dict:
+    """
+    Map each set 'KEY=value' line to its raw value, the first setting wins
+    """
+    config = {}
+    for line in content.splitlines():
+        if line and not line.startswith("#"):
+            key, sep, value = line.partition("=")
+            if sep:
+                config.setdefault(key, value)
+
+    return config
+
+
+class KernelConfigIndex:
+    """
+    Each kernel config is parsed once. Configs are found by (path, mtime, size),
+    and by content hash so the same kernel in many boot environments is only
+    parsed once. If 'store' is given, parsed configs are also kept between runs.
+    """
+
+    def __init__(self, store: Optional[zedenv_grub.cache.Cache] = None):
+        self.store = store
+        self.stats = {}
+        self.configs = {}
+
+        if store:
+            self.stats = store.data.get("stats", {})
+            self.configs = store.data.get("configs", {})
+
+        self.used_paths = set()
+        self.used_hashes = set()
+
+    def get(self, path: str) -> dict:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {}
+
+        stat_key = [st.st_mtime_ns, st.st_size]
+        stat_entry = self.stats.get(path)
+
+        if stat_entry and stat_entry[:2] == stat_key and stat_entry[2] in self.configs:
+            content_hash = stat_entry[2]
+        else:
+            try:
+                with open(path, "rb") as f:
+                    content = f.read()
+            except OSError:
+                return {}
+
+            content_hash = hashlib.sha256(content).hexdigest()
+            if content_hash not in self.configs:
+                self.configs[content_hash] = parse_config(content.decode(errors="replace"))
+
+            self.stats[path] = [*stat_key, content_hash]
+            if self.store:
+                self.store.dirty = True
+
+        self.used_paths.add(path)
+        self.used_hashes.add(content_hash)
+
+        return self.configs[content_hash]
+
+    def save(self):
+        """
+        Persist the configs used in this run, dropping the rest
+        """
+        if not self.store:
+            return
+
+        stats = {p: s for p, s in self.stats.items() if p in self.used_paths}
+        configs = {h: c for h, c in self.configs.items() if h in self.used_hashes}
+
+        if stats.keys() != self.stats.keys() or configs.keys() != self.configs.keys():
+            self.store.dirty = True
+
+        self.store.data = {"stats": stats, "configs": configs}
+        self.store.save()
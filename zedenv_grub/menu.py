@@ -0,0 +1,164 @@
+"""
+Targeted edits of the generated boot environment menu, by entry id
+"""
+
+import re
+
+from typing import List, NamedTuple, Optional
+
+block_regex = re.compile(r"^(\s*)(menuentry|submenu) .*\$menuentry_id_option '([^']*)' \{$")
+
+# Boots 'saved_entry' from grubenv unless grub-reboot chose an entry for this boot
+SAVED_DEFAULT = 'set default="${saved_entry}"'
+
+
+class Block(NamedTuple):
+    kind: str
+    entry_id: str
+    start: int
+    end: int
+
+
+def blocks(lines: List[str]) -> Optional[List[Block]]:
+    """
+    Find every menuentry and submenu block, or None if their braces don't match
+    """
+    found = []
+    # (kind, id, start line, indentation) of the blocks still open
+    open_blocks = []
+
+    for i, line in enumerate(lines):
+        block = block_regex.match(line)
+        if block:
+            open_blocks.append((block.group(2), block.group(3), i, block.group(1)))
+        elif line.strip() == "}" and open_blocks:
+            kind, entry_id, start, indent = open_blocks[-1]
+            if line[:len(line) - len(line.lstrip())] == indent:
+                open_blocks.pop()
+                found.append(Block(kind, entry_id, start, i))
+
+    return None if open_blocks else found
+
+
+def default_entry_id(dataset: str) -> str:
+    return f"gnulinux-simple-{dataset}"
+
+
+def grubenv_default(dataset: str) -> List[str]:
+    """
+    Select the default entry from 'saved_entry' in grubenv,
+    falling back to a boot environment's entry if it isn't set
+    """
+    return [
+        'if [ -z "${boot_once}" ]; then',
+        '  if [ "${saved_entry}" ]; then',
+        f'    {SAVED_DEFAULT}',
+        '  else',
+        f'    set default="{default_entry_id(dataset)}"',
+        '  fi',
+        'fi'
+    ]
+
+
+def has_grubenv_default(lines: List[str], dataset: str) -> bool:
+    """
+    Check a generated menu selects its default from grubenv
+    and has a top level entry to boot a boot environment by
+    """
+    if SAVED_DEFAULT not in (line.strip() for line in lines):
+        return False
+
+    entry_id = default_entry_id(dataset)
+    return any(b.kind == "menuentry" and b.entry_id == entry_id and
+               not lines[b.start][:1].isspace() for b in blocks(lines) or [])
+
+
+def dataset_id_regex(dataset: str):
+    """
+    Match the ids generate_entry() gives a boot environment's entries
+    """
+    return re.compile(rf"^gnulinux-(.*-)?(simple|advanced|recovery)-{re.escape(dataset)}$")
+
+
+def dataset_blocks(lines: List[str], dataset: str) -> List[Block]:
+    id_regex = dataset_id_regex(dataset)
+    return [b for b in blocks(lines) or [] if id_regex.match(b.entry_id)]
+
+
+def editable_blocks(lines: List[str], dataset: str) -> Optional[List[Block]]:
+    """
+    Get the entries of a boot environment, or None if it has none or is the active one
+    """
+    menu_blocks = blocks(lines)
+    if not menu_blocks:
+        return None
+
+    # The submenu of other boot environments is named after the active one,
+    # whose entries head the menu and can't be edited in place
+    if any(b.kind == "submenu" and b.entry_id.endswith(f"-{dataset}") for b in menu_blocks):
+        return None
+
+    id_regex = dataset_id_regex(dataset)
+    return [b for b in menu_blocks if id_regex.match(b.entry_id)] or None
+
+
+def remove_entries(section: str, dataset: str) -> Optional[str]:
+    """
+    Remove every entry of a boot environment from a generated menu
+    """
+    lines = section.splitlines()
+    matching = editable_blocks(lines, dataset)
+    if not matching:
+        return None
+
+    removed = set()
+    for b in matching:
+        removed.update(range(b.start, b.end + 1))
+
+    remaining = [line for i, line in enumerate(lines) if i not in removed]
+
+    # A submenu left without entries is not what a full rebuild would produce
+    for b in blocks(remaining):
+        if b.kind == "submenu" and not any(
+                block_regex.match(line) for line in remaining[b.start + 1:b.end]):
+            return None
+
+    return "".join(f"{line}\n" for line in remaining)
+
+
+def rename_entries(section: str, old_dataset: str, new_dataset: str) -> Optional[str]:
+    """
+    Rewrite the titles, ids, kernel paths and root dataset of
+    a boot environment's entries after it was renamed
+    """
+    lines = section.splitlines()
+    matching = editable_blocks(lines, old_dataset)
+    if not matching or dataset_blocks(lines, new_dataset):
+        return None
+
+    old_name = old_dataset.rsplit("/", 1)[-1]
+    new_name = new_dataset.rsplit("/", 1)[-1]
+
+    # Kernel paths are relative to the pool, '/<dataset without pool>@/boot/...'
+    old_path = f"/{old_dataset.partition('/')[2]}@"
+    new_path = f"/{new_dataset.partition('/')[2]}@"
+    if old_path == "/@" or new_path == "/@":
+        return None
+
+    path_regex = re.compile(rf"(?<![\w./-]){re.escape(old_path)}")
+    root_regex = re.compile(rf"ZFS={re.escape(old_dataset)}(?=\s|$)")
+    id_regex = re.compile(rf"-{re.escape(old_dataset)}' \{{$")
+
+    for b in matching:
+        title_line = lines[b.start].replace(f" BE [{old_name}]", f" BE [{new_name}]", 1)
+        lines[b.start] = id_regex.sub(f"-{new_dataset}' {{", title_line)
+
+        for i in range(b.start + 1, b.end):
+            lines[i] = root_regex.sub(f"ZFS={new_dataset}", path_regex.sub(new_path, lines[i]))
+
+    # The fallback default of a menu that selects it from grubenv
+    old_default = f'set default="{default_entry_id(old_dataset)}"'
+    lines = [line.replace(old_default, f'set default="{default_entry_id(new_dataset)}"')
+             if line.strip() == old_default else line for line in lines]
+
+    return "".join(f"{line}\n" for line in lines)
@@ -0,0 +1,194 @@
+"""
+Regenerate only the zedenv section of an existing grub.cfg
+"""
+
+import glob
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import shlex
+import shutil
+import stat
+import subprocess
+import tempfile
+
+from typing import List, Optional, Tuple
+
+GRUB_D = "/etc/grub.d"
+DEFAULTS = "/etc/default/grub"
+GENERATOR = os.path.join(GRUB_D, "05_zfs_linux.py")
+
+BEGIN_MARKER = f"### BEGIN {GENERATOR} ###"
+END_MARKER = f"### END {GENERATOR} ###"
+
+
+def path_stats(paths: List[str]) -> list:
+    stats = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+        except OSError:
+            stats.append([p, None])
+        else:
+            if stat.S_ISDIR(st.st_mode):
+                # Directory times change with anything written below them, grub.cfg included
+                stats.append([p, "directory"])
+            else:
+                stats.append([p, st.st_mode, st.st_mtime_ns, st.st_size])
+
+    return stats
+
+
+def defaults_files(defaults: str = DEFAULTS) -> List[str]:
+    """
+    The files grub-mkconfig reads GRUB defaults from, in the order it sources them
+    """
+    return [defaults, *sorted(glob.glob(os.path.join(f"{defaults}.d", "*.cfg")))]
+
+
+def source_defaults(defaults: str = DEFAULTS):
+    """
+    Source GRUB defaults into the environment like grub-mkconfig does,
+    so settings in /etc/default/grub.d override /etc/default/grub
+    """
+    sourced = [f". {shlex.quote(f)}" for f in defaults_files(defaults) if os.path.isfile(f)]
+    env_command = ['sh', '-c', " && ".join(["set -a", *sourced, "env"])]
+
+    try:
+        env_output = subprocess.check_output(
+            env_command, universal_newlines=True, stderr=subprocess.PIPE)
+    except (subprocess.CalledProcessError, OSError) as e:
+        raise RuntimeError(f"Failed to source {defaults}.\n{e}\n.")
+
+    for line in env_output.splitlines():
+        (key, _, value) = line.partition("=")
+        os.environ[key] = value
+
+
+def dir_stats(directory: str, exclude: tuple = ()) -> list:
+    try:
+        names = sorted(n for n in os.listdir(directory) if n not in exclude)
+    except OSError:
+        return [directory, None]
+
+    return path_stats([os.path.join(directory, n) for n in names])
+
+
+def inputs_fingerprint(grub_boot_dir: str, grub_cfg: str) -> str:
+    """
+    Fingerprint what the other /etc/grub.d scripts read: GRUB defaults, the
+    scripts themselves, kernels and files in /boot, the GRUB directory
+    apart from its generated files, and the disks os-prober looks at
+    """
+    fingerprint_input = {
+        "defaults": path_stats(defaults_files()),
+        "scripts": dir_stats(GRUB_D),
+        "mkconfig": path_stats([shutil.which("grub-mkconfig") or "grub-mkconfig"]),
+        "boot": dir_stats("/boot"),
+        "grub": dir_stats(grub_boot_dir, exclude=(grub_cfg, f"{grub_cfg}.new", "grubenv")),
+        "disks": dir_stats("/dev/disk/by-uuid")
+    }
+
+    return hashlib.sha256(
+        json.dumps(fingerprint_input, sort_keys=True).encode()).hexdigest()
+
+
+def section_bounds(grub_cfg: str) -> Optional[Tuple[int, int]]:
+    """
+    Get the start and end offsets of the zedenv section's content,
+    or None if the config doesn't have exactly one zedenv section
+    """
+    if grub_cfg.count(BEGIN_MARKER) != 1 or grub_cfg.count(END_MARKER) != 1:
+        return None
+
+    begin = grub_cfg.find(f"\n{BEGIN_MARKER}\n")
+    end = grub_cfg.find(f"\n{END_MARKER}\n")
+    if begin < 0 or end < begin:
+        return None
+
+    # For an empty section the END marker's leading newline ends the BEGIN line
+    return begin + len(BEGIN_MARKER) + 2, end + 1
+
+
+def section(grub_cfg: str) -> Optional[str]:
+    """
+    Get the zedenv section of a grub.cfg, or None if it doesn't have exactly one
+    """
+    bounds = section_bounds(grub_cfg)
+    return grub_cfg[bounds[0]:bounds[1]] if bounds else None
+
+
+def splice(grub_cfg: str, new_section: str) -> Optional[str]:
+    """
+    Replace the zedenv section of a grub.cfg, or None if it doesn't have exactly one
+    """
+    bounds = section_bounds(grub_cfg)
+    if not bounds:
+        return None
+
+    return f"{grub_cfg[:bounds[0]]}{new_section}{grub_cfg[bounds[1]:]}"
+
+
+def generate_section(generator: str = GENERATOR) -> str:
+    """
+    Run the installed generator in this process and return what it would print
+    between the markers. The generator exits on fatal errors, so callers should
+    be prepared for SystemExit as well as the usual errors.
+    """
+    spec = importlib.util.spec_from_file_location("zedenv_grub_generator", generator)
+    if not spec:
+        raise RuntimeError(f"Couldn't load {generator}.")
+
+    module = importlib.util.module_from_spec(spec)
+
+    # The generator sources GRUB defaults into the environment
+    environ = dict(os.environ)
+    try:
+        spec.loader.exec_module(module)
+        section = io.StringIO()
+        for entry in module.Generator().generate_grub_entries():
+            section.writelines(f"{line}\n" for line in entry)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+    return section.getvalue()
+
+
+def check_syntax(path: str):
+    try:
+        subprocess.check_call(["grub-script-check", path],
+                              universal_newlines=True, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        # grub-mkconfig only checks the syntax when the tool is available too
+        pass
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Syntax errors in generated config.\n{e}")
+
+
+def write_config(location: str, grub_cfg: str):
+    """
+    Check the syntax of a new grub.cfg and atomically replace the old one,
+    keeping its permissions
+    """
+    cfg_dir = os.path.dirname(location)
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=cfg_dir, prefix=".grub.cfg")
+    except OSError as e:
+        raise RuntimeError(f"Failed to write {location}.\n{e}")
+
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(grub_cfg)
+
+        shutil.copymode(location, temp_path)
+        check_syntax(temp_path)
+        os.replace(temp_path, location)
+    except (OSError, RuntimeError) as e:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise RuntimeError(f"Failed to write {location}.\n{e}")
@@ -0,0 +1,78 @@
+"""
+Mount table lookups from /proc/self/mountinfo
+"""
+
+import os
+import re
+
+from typing import Optional, Tuple
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+
+def unescape(field: str) -> str:
+    """
+    Undo the octal escaping of spaces, tabs, newlines and backslashes
+    """
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+class MountInfo:
+    """
+    Index of mountpoint to (root, fstype, source), read once
+    """
+
+    def __init__(self, mountinfo: str = MOUNTINFO):
+        self.mounts = {}
+
+        try:
+            with open(mountinfo) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            lines = []
+
+        for line in lines:
+            fields = line.split()
+            try:
+                separator = fields.index("-", 6)
+                root, mountpoint = fields[3], fields[4]
+                fstype, source = fields[separator + 1], fields[separator + 2]
+            except (ValueError, IndexError):
+                continue
+
+            # Later mounts on the same mountpoint hide earlier ones
+            self.mounts[unescape(mountpoint)] = (
+                unescape(root), fstype, unescape(source))
+
+    def find_mount(self, path: str) -> Optional[Tuple[str, str, str, str]]:
+        """
+        Get (mountpoint, root, fstype, source) of the mount containing path
+        """
+        mountpoint = os.path.realpath(path)
+
+        while True:
+            if mountpoint in self.mounts:
+                return (mountpoint, *self.mounts[mountpoint])
+            if mountpoint == "/":
+                return None
+            mountpoint = os.path.dirname(mountpoint)
+
+    def zfs_relpath(self, path: str) -> Optional[str]:
+        """
+        Produce the same '/<dataset>@/<path>' string grub-mkrelpath does for
+        a path on ZFS, or None if the path is not on a plainly mounted dataset
+        """
+        mount = self.find_mount(path)
+        if not mount:
+            return None
+
+        mountpoint, root, fstype, source = mount
+        if fstype != "zfs" or root != "/":
+            return None
+
+        real_path = os.path.realpath(path)
+        rel = "" if real_path == mountpoint else real_path[len(mountpoint.rstrip("/")):]
+
+        _, _, dataset = source.partition("/")
+
+        return f"/{dataset}@{rel}"
@@ -0,0 +1,110 @@
+"""
+Boot environment mounts kept between runs
+"""
+
+import os
+import subprocess
+import time
+
+import zedenv_grub.cache
+import zedenv_grub.mountinfo
+
+from typing import Callable, List, Optional
+
+# Under /run so the state is cleared on boot along with the mounts it describes
+STATE_DIR = "/run/zedenv-grub"
+
+
+def unmount(mount_path: str, retries: int = 0, lazy: bool = False,
+            on_retry: Optional[Callable[[str, float], None]] = None) -> Optional[str]:
+    """
+    Unmount a boot environment, retrying with backoff while it is busy.
+    A lazy unmount detaches it right away and lets the kernel finish once it is unused.
+    'on_retry' is called with the error and the delay before each retry.
+    Returns the error if it couldn't be unmounted.
+    """
+    umount_call = ["umount", "-l", mount_path] if lazy else ["umount", mount_path]
+
+    delay = 0.25
+    for attempt in range(retries + 1):
+        try:
+            subprocess.check_call(umount_call, universal_newlines=True, stderr=subprocess.PIPE)
+        except (subprocess.CalledProcessError, OSError) as e:
+            error = f"Failed to unmount {mount_path}.\n{e}."
+        else:
+            return None
+
+        if attempt < retries:
+            if on_retry:
+                on_retry(error, delay)
+            time.sleep(delay)
+            delay *= 2
+
+    return error
+
+
+class MountState(zedenv_grub.cache.Cache):
+    """
+    Mount directories left mounted between runs, by path, with the boot environment
+    mounted there and the operations holding it. A mount is released, and can be
+    unmounted, once its boot environment is destroyed or renamed or on cleanup.
+    """
+
+    def __init__(self, state_dir: str = STATE_DIR):
+        super().__init__("mounts", state_dir)
+
+        if not isinstance(self.data.get("mounts"), dict):
+            self.data["mounts"] = {}
+
+    @property
+    def mounts(self) -> dict:
+        return self.data["mounts"]
+
+    def hold(self, mount_path: str, dataset: str, holder: str):
+        mount = self.mounts.get(mount_path)
+        if not mount or mount.get("dataset") != dataset:
+            mount = self.mounts[mount_path] = {"dataset": dataset, "holders": []}
+            self.dirty = True
+
+        if holder not in mount["holders"]:
+            mount["holders"].append(holder)
+            self.dirty = True
+
+    def holds(self, mount_path: str, dataset: str) -> bool:
+        mount = self.mounts.get(mount_path)
+        return bool(mount) and mount.get("dataset") == dataset
+
+    def release(self, mount_path: str):
+        if self.mounts.pop(mount_path, None) is not None:
+            self.dirty = True
+
+    def prune(self):
+        """
+        Forget mounts that were unmounted behind our back
+        """
+        mounted = zedenv_grub.mountinfo.MountInfo().mounts
+        for mount_path in [m for m in self.mounts if os.path.realpath(m) not in mounted]:
+            self.release(mount_path)
+
+    def cleanup(self) -> List[str]:
+        """
+        Unmount and remove every held mount, returning errors for those left mounted
+        """
+        self.prune()
+
+        errors = []
+        for mount_path in list(self.mounts):
+            error = unmount(mount_path)
+            if error:
+                errors.append(error)
+                continue
+
+            self.release(mount_path)
+            try:
+                os.rmdir(mount_path)
+            except OSError:
+                pass
+
+        self.save()
+
+        return errors
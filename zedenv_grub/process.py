@@ -0,0 +1,36 @@
+"""
+Run commands that may hang, such as probes of an unresponsive disk, without waiting on them forever
+"""
+
+import subprocess
+
+from typing import List, Optional
+
+# Seconds to wait for a command to exit after it was killed
+KILL_WAIT = 1
+
+
+def check_output(call: List[str], timeout: Optional[float] = None, **kwargs) -> str:
+    """
+    Like subprocess.check_output, except that a command that times out is killed and
+    only waited for briefly. A command stuck in uninterruptible I/O can't be killed,
+    it is left behind unreaped instead of blocking the caller.
+    Raises subprocess.TimeoutExpired and subprocess.CalledProcessError.
+    """
+    kwargs.setdefault("stdout", subprocess.PIPE)
+    process = subprocess.Popen(call, universal_newlines=True, **kwargs)
+
+    try:
+        output, error = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        try:
+            process.communicate(timeout=KILL_WAIT)
+        except subprocess.TimeoutExpired:
+            pass
+        raise subprocess.TimeoutExpired(call, timeout)
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, call, output, error)
+
+    return output
@@ -0,0 +1,95 @@
+"""
+Answer grub-probe targets for ZFS devices without running grub-probe
+"""
+
+import os
+import subprocess
+
+import zedenv_grub.zfs
+
+from typing import List, Optional
+
+
+def grub_probe(call_args: List[str]) -> List[str]:
+    try:
+        probe_output = subprocess.check_output(
+            ["grub-probe", *call_args], universal_newlines=True, stderr=subprocess.PIPE)
+    except (subprocess.CalledProcessError, OSError) as e:
+        raise RuntimeError(f"Failed to run grub-probe.\n{e}.")
+
+    return probe_output.splitlines()
+
+
+class ZFSResolver:
+    """
+    Pool metadata is enough to answer the filesystem targets for a ZFS pool:
+    the filesystem is 'zfs', its UUID is the pool GUID in hex, and vdevs on
+    whole disks or partitions need no abstraction or cryptodisk modules.
+    Anything else, such as vdevs on device-mapper or md devices, is left to grub-probe.
+    """
+
+    targets = ("fs", "fs_uuid", "abstraction", "cryptodisk_uuid")
+
+    def __init__(self, pools: zedenv_grub.zfs.Pools):
+        self.pools = pools
+
+        self.device_pools = {}
+        for pool, vdevs in pools.vdevs.items():
+            for v in vdevs:
+                self.device_pools[os.path.realpath(v)] = pool
+
+    def devices_pool(self, devices: List[str]) -> Optional[str]:
+        """
+        Get the pool if every device is a vdev of the same pool
+        """
+        device_pools = {self.device_pools.get(os.path.realpath(d)) for d in devices}
+        if len(device_pools) != 1:
+            return None
+
+        return device_pools.pop()
+
+    @staticmethod
+    def plain_device(device: str) -> bool:
+        name = os.path.basename(os.path.realpath(device))
+        return not name.startswith(("dm-", "md"))
+
+    def resolve(self, target: str, devices: List[str]) -> Optional[List[str]]:
+        if target not in self.targets or not devices:
+            return None
+
+        pool = self.devices_pool(devices)
+        if not pool or pool not in self.pools.guids:
+            return None
+
+        if target == "fs":
+            return ["zfs"]
+
+        if target == "fs_uuid":
+            return [f"{self.pools.guids[pool]:016x}"]
+
+        if all(self.plain_device(v) for v in self.pools.vdevs[pool]):
+            # abstraction and cryptodisk_uuid print nothing for plain devices
+            return []
+
+        return None
+
+    def verify(self, devices: List[str]) -> List[tuple]:
+        """
+        Compare native answers with grub-probe, returning (target, native, grub-probe)
+        for every target that does not match byte for byte
+        """
+        mismatches = []
+        for target in self.targets:
+            native = self.resolve(target, devices)
+            if native is None:
+                continue
+
+            try:
+                probed = grub_probe(["--device", *devices, f"--target={target}"])
+            except RuntimeError as e:
+                probed = [str(e)]
+
+            if "\n".join(native) != "\n".join(probed):
+                mismatches.append((target, native, probed))
+
+        return mismatches
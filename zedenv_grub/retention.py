@@ -0,0 +1,52 @@
+"""
+Which boot environments the menu keeps when there are too many
+"""
+
+import time
+
+import zedenv_grub.zfs
+
+from typing import NamedTuple, Optional, Set
+
+SECONDS_PER_DAY = 86400
+
+
+class Policy(NamedTuple):
+    """
+    Keep the newest 'max_count' boot environments created in the last 'max_age' days,
+    a limit of 0 meaning no limit. The boot environments in 'keep' and the
+    one mounted at '/' are always kept.
+    """
+    max_count: int = 0
+    max_age: float = 0
+    keep: tuple = ()
+
+    def retained(self, boot_environments: zedenv_grub.zfs.BootEnvironments,
+                 now: Optional[float] = None) -> Optional[Set[str]]:
+        """
+        Get the names of the boot environments to keep, or None if every one is kept
+        """
+        if not self.max_count and not self.max_age:
+            return None
+
+        oldest = (time.time() if now is None else now) - self.max_age * SECONDS_PER_DAY
+
+        def created(be: dict, column: str) -> int:
+            try:
+                return int(be[column])
+            except ValueError:
+                return 0
+
+        # Newest first, by the transaction group they were created in
+        candidates = sorted(
+            (n for n, be in boot_environments.table.items()
+             if not self.max_age or created(be, "creation") >= oldest),
+            key=lambda n: created(boot_environments.table[n], "createtxg"), reverse=True)
+        if self.max_count:
+            candidates = candidates[:self.max_count]
+
+        retained = set(candidates)
+        retained.update(n for n, be in boot_environments.table.items()
+                        if be["name"] in self.keep or boot_environments.is_root(be))
+
+        return retained
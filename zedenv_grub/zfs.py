@@ -0,0 +1,217 @@
+"""
+Batched queries of ZFS pool and dataset metadata
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+
+from typing import List, Optional
+
+
+def zfs_command(command: str, call_args: List[str]) -> List[str]:
+    """
+    Run 'zfs' or 'zpool' and return its output lines
+    """
+    try:
+        cmd_output = subprocess.check_output(
+            [command, *call_args], universal_newlines=True, stderr=subprocess.PIPE)
+    except (subprocess.CalledProcessError, OSError) as e:
+        raise RuntimeError(f"Failed to run {command}.\n{e}.")
+
+    return cmd_output.splitlines()
+
+
+def vdev_topology(status_lines: List[str]) -> List[str]:
+    """
+    Reduce 'zpool status' output to the vdev tree in its 'config:' sections,
+    keeping indentation and names but dropping state and error counters
+    """
+    topology = []
+    in_config = False
+
+    for line in status_lines:
+        stripped = line.strip()
+        if stripped == "config:":
+            in_config = True
+        elif stripped.startswith("errors:"):
+            in_config = False
+        elif in_config and stripped and not stripped.startswith("NAME"):
+            indent = len(line) - len(line.lstrip())
+            topology.append(f"{indent}:{stripped.split()[0]}")
+
+    return topology
+
+
+def vdev_devices(status_lines: List[str]) -> dict:
+    """
+    Map each pool in 'zpool status -P' output to the device paths of its vdevs
+    """
+    devices = {}
+    pool = None
+    in_config = False
+
+    for line in status_lines:
+        stripped = line.strip()
+        if stripped.startswith("pool:"):
+            pool = stripped.split(None, 1)[1]
+            devices[pool] = []
+        elif stripped == "config:":
+            in_config = True
+        elif stripped.startswith("errors:"):
+            in_config = False
+        elif in_config and pool and stripped.startswith("/"):
+            devices[pool].append(stripped.split()[0])
+
+    return devices
+
+
+class Pools:
+    """
+    GUIDs, boot filesystems and vdev layout of every imported pool, from one 'zpool get'
+    and one 'zpool status' call. Output can be passed in directly instead of running them.
+    """
+
+    def __init__(self, get_lines: Optional[List[str]] = None,
+                 status_lines: Optional[List[str]] = None):
+        if get_lines is None:
+            get_lines = zfs_command(
+                "zpool", ["get", "-H", "-p", "-o", "name,property,value", "guid,bootfs"])
+        if status_lines is None:
+            status_lines = zfs_command("zpool", ["status", "-P", "-L"])
+
+        self.guids = {}
+        self.bootfs = {}
+        for line in get_lines:
+            fields = line.split("\t")
+            if len(fields) != 3:
+                continue
+
+            name, prop, value = fields
+            if prop == "guid":
+                try:
+                    self.guids[name] = int(value)
+                except ValueError:
+                    continue
+            elif prop == "bootfs":
+                self.bootfs[name] = value
+
+        self.vdevs = vdev_devices(status_lines)
+        self.topology = vdev_topology(status_lines)
+
+
+def probe_fingerprint(root_dataset: str, boot_paths: List[str], pools: Pools) -> str:
+    """
+    Fingerprint everything grub-probe answers depend on: pool GUIDs,
+    vdev topology, encryption state and the devices backing the boot paths
+    """
+    try:
+        encryption = zfs_command(
+            "zfs", ["get", "-H", "-p", "-o", "value", "encryption", root_dataset])
+    except RuntimeError:
+        # ZFS without native encryption support
+        encryption = []
+
+    boot_devices = []
+    for p in boot_paths:
+        try:
+            boot_devices.append([p, os.stat(p).st_dev])
+        except OSError:
+            boot_devices.append([p, None])
+
+    fingerprint_input = {
+        "guids": pools.guids,
+        "topology": pools.topology,
+        "encryption": encryption,
+        "cryptodisk": os.environ.get("GRUB_ENABLE_CRYPTODISK"),
+        "boot": boot_devices
+    }
+
+    return hashlib.sha256(
+        json.dumps(fingerprint_input, sort_keys=True).encode()).hexdigest()
+
+
+class BootEnvironments:
+    """
+    Every boot environment under a boot environment root with its mount state,
+    creation, change stamp and kernel inventory, from one 'zfs list' call that also
+    returns their snapshots. Output can be passed in directly instead of running it.
+    """
+
+    inventory_property = "org.zedenv.grub:kernels"
+
+    columns = ("name", "mountpoint", "canmount", "mounted", "guid", "createtxg",
+               "creation", "written", "referenced", inventory_property)
+
+    def __init__(self, be_root: str, list_lines: Optional[List[str]] = None,
+                 root_dataset: Optional[str] = None):
+        if list_lines is None:
+            list_lines = zfs_command("zfs", ["list", "-H", "-p", "-t", "filesystem,snapshot",
+                                             "-d", "2", "-o", ",".join(self.columns), be_root])
+
+        self.be_root = be_root
+        self.root_dataset = root_dataset
+
+        # Boot environment name to its properties, in 'zfs list' order
+        self.table = {}
+        # Boot environment dataset to the createtxg of its latest snapshot
+        snapshot_txgs = {}
+        for line in list_lines:
+            fields = line.split("\t")
+            if len(fields) != len(self.columns):
+                continue
+
+            be = dict(zip(self.columns, fields))
+            dataset, snapshot, _ = be["name"].partition("@")
+            if snapshot:
+                try:
+                    txg = int(be["createtxg"])
+                except ValueError:
+                    continue
+                snapshot_txgs[dataset] = max(txg, snapshot_txgs.get(dataset, 0))
+            elif dataset.rpartition("/")[0] == be_root:
+                self.table[dataset.rsplit("/", 1)[-1]] = be
+
+        for be in self.table.values():
+            be["snapshottxg"] = str(snapshot_txgs.get(be["name"], 0))
+
+    def is_root(self, be: dict) -> bool:
+        """
+        Check if a boot environment is the one mounted at '/'
+        """
+        if self.root_dataset:
+            return be["name"] == self.root_dataset
+
+        return be["mounted"] == "yes" and be["mountpoint"] == "/"
+
+
+class Properties:
+    """
+    Every 'org.zedenv' user property of a set of datasets, local or inherited,
+    from one 'zfs get' call. Output can be passed in directly instead of running it.
+    """
+
+    prefix = "org.zedenv"
+
+    def __init__(self, datasets: List[str], get_lines: Optional[List[str]] = None):
+        self.datasets = list(dict.fromkeys(datasets))
+
+        if get_lines is None:
+            get_lines = zfs_command("zfs", ["get", "-H", "-p", "-o", "name,property,value",
+                                            "all", *self.datasets])
+
+        self.values = {}
+        for line in get_lines:
+            fields = line.split("\t")
+            if len(fields) == 3 and fields[1].startswith(self.prefix):
+                self.values[(fields[0], fields[1])] = fields[2]
+
+    def get(self, dataset: str, prop: str) -> str:
+        """
+        Get a property value, '-' if it is unset like 'zfs get' reports
+        """
+        if dataset not in self.datasets:
+            raise KeyError(f"Dataset {dataset} is not in the property snapshot.")
+
+        return self.values.get((dataset, prop), "-")